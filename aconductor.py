@@ -0,0 +1,301 @@
+# An asyncio conductor: the same schedule, notify and participation rules as
+# player.py's SimPy conductor, on one event loop. Scheduled mood changes and
+# player wake-ups share one heap of timers, phrases are composed on the loop,
+# and messages go out through an AsyncOutput per port instead of a thread.
+# Waking up late is recorded as a Violation rather than stopping the run.
+import asyncio
+import heapq
+import itertools
+import logging
+
+import metrics
+from main import sequence_events
+from player import Player
+from scheduler import DeadlineScheduler, JitterStats
+from timing import PPQ, beats_to_ticks, ticks_to_seconds
+
+log = logging.getLogger("raga.aconductor")
+violation_log = logging.getLogger("raga.aconductor.violations")
+violation_log.addFilter(metrics.RateLimitFilter(interval=1.0))
+
+MOOD, PLAYER = 0, 1  # timer kinds; on the same tick moods change first
+
+
+class AsyncOutput:
+    """
+    Sends (deadline, message) events to an OutputBackend from a task on the
+    event loop, in deadline order. Deadlines are loop.time() values.
+    """
+
+    def __init__(self, output, late_policy="catchup", late_threshold=0.02):
+        self.output = output
+        self.late_policy = late_policy
+        self.late_threshold = late_threshold
+        self.stats = JitterStats()
+        self._queue = []  # heap of (deadline, submission order, message)
+        self._order = itertools.count()
+        self._wake = None
+        self._task = None
+        self._scheduler = None
+
+    def start(self):
+        if self._task is None:
+            loop = asyncio.get_running_loop()
+            self._wake = asyncio.Event()
+            self._scheduler = DeadlineScheduler(
+                self.output,
+                late_policy=self.late_policy,
+                late_threshold=self.late_threshold,
+                clock=loop.time,
+            )
+            self._task = loop.create_task(self._run())
+
+    def submit(self, events, start, end=None):
+        # events are (offset in seconds, message) pairs relative to start;
+        # with end, deadlines that float rounding pushes past it are held to
+        # it, so they never go out after the next phrase's first note
+        for offset, msg in events:
+            deadline = start + offset if end is None else min(start + offset, end)
+            heapq.heappush(self._queue, (deadline, next(self._order), msg))
+        metrics.get_metrics().set("playback_queue_depth", len(self._queue))
+        self.start()
+        self._wake.set()
+
+    def pending(self):
+        return len(self._queue)
+
+    async def flush(self):
+        while self._queue:
+            await asyncio.sleep(0.001)
+
+    async def close(self):
+        # Sends the note_offs still queued, then stops
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for _, _, msg in sorted(self._queue):
+            if msg.type == "note_off":
+                self.output.send(msg)
+        self._queue = []
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        queue = self._queue
+        while True:
+            if not queue:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            delay = queue[0][0] - loop.time()
+            if delay > 0:
+                # an earlier event may be submitted meanwhile, so look again
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            now = loop.time()
+            while queue and queue[0][0] <= now:
+                deadline, _, msg = heapq.heappop(queue)
+                self._scheduler.send_due(deadline, msg, self.stats)
+
+
+class Violation:
+    """A timer that fired `lateness` seconds after it was due."""
+
+    def __init__(self, tick, lateness, kind):
+        self.tick = tick
+        self.lateness = lateness
+        self.kind = kind
+
+    def __repr__(self):
+        return f"Violation(tick={self.tick}, lateness={self.lateness:.4f}, kind={self.kind!r})"
+
+
+class AsyncConductor:
+    """
+    Drives Players (created with env=None) from one coroutine. Times are ticks
+    on a clock anchored when run() starts.
+
+    Timers fire `lookahead` seconds before their tick, so a phrase is
+    composed and queued before it is due to sound. A timer up to
+    `late_threshold` seconds late is normal; later than that it is recorded
+    in `violations` (and passed to on_violation). Past `max_lag` the clock is
+    re-anchored so the music resumes from now instead of rushing to catch up.
+    """
+
+    def __init__(
+        self,
+        schedule,
+        raga=None,
+        bpm=None,
+        ppq=PPQ,
+        lookahead=0.1,
+        late_threshold=0.01,
+        max_lag=0.25,
+        on_violation=None,
+        late_policy="catchup",
+    ):
+        self.raga = raga  # sent MMC play on start when given
+        self.bpm = bpm if bpm is not None else raga.bpm if raga is not None else None
+        self.ppq = ppq
+        self.lookahead = lookahead
+        self.late_threshold = late_threshold
+        self.max_lag = max_lag
+        self.on_violation = on_violation
+        self.late_policy = late_policy
+        self.players = []
+        self.violations = []
+        self.outputs = {}  # id(backend) -> AsyncOutput
+        self.now = 0  # current tick
+        self._timers = []  # heap of (tick, kind, order, payload)
+        self._order = itertools.count()
+        self._origin = None
+        self._running = False
+        for item in schedule:
+            self.scheduleevent(item)
+
+    def scheduleevent(self, item):
+        self._push(beats_to_ticks(item.time, self.ppq), MOOD, item)
+
+    def addplayer(self, player):
+        self.players.append(player)
+        player.conductor = self
+        if self.bpm is None:
+            self.bpm = player.raga.bpm
+
+    def _push(self, tick, kind, payload):
+        heapq.heappush(self._timers, (tick, kind, next(self._order), payload))
+
+    def time_of(self, tick):
+        # loop time a tick is due at
+        return self._origin + ticks_to_seconds(tick, self.bpm, self.ppq)
+
+    def output_for(self, player):
+        backend = player.raga.outport
+        output = self.outputs.get(id(backend))
+        if output is None or output.output is not backend:
+            output = self.outputs[id(backend)] = AsyncOutput(
+                backend, late_policy=self.late_policy
+            )
+        return output
+
+    def notify(self, event):
+        log.info("notify mood=%s", event.mood)
+        for player in self.players:
+            if event.name in player.participation:
+                player.mood = event.mood
+            else:
+                player.mood = None  # no mood to play
+            if player.buffer is not None:
+                player.checkmood()
+
+    def perform(self, player, tick):
+        # One phrase for a player due at tick; returns when it is next due
+        if not player.mood:
+            return tick + self.ppq - tick % self.ppq  # check again next beat
+        player.checkmood()
+        midi_sequence, playing_ticks = player.compose()
+        self.output_for(player).submit(
+            sequence_events(midi_sequence),
+            self.time_of(tick),
+            self.time_of(tick + playing_ticks),
+        )
+        return tick + max(playing_ticks, 1)
+
+    def stop(self):
+        self._running = False
+
+    def violation(self, tick, lateness, kind):
+        violation = Violation(tick, lateness, kind)
+        self.violations.append(violation)
+        metrics.get_metrics().inc("realtime_violations_total")
+        violation_log.warning("late tick=%d lateness=%.4f", tick, lateness)
+        if self.on_violation is not None:
+            self.on_violation(violation)
+        if lateness > self.max_lag:
+            # give up on the lost time rather than rushing through it
+            self._origin += lateness
+        return violation
+
+    async def run(self, until=None):
+        # until is in beats; None runs until stop()
+        loop = asyncio.get_running_loop()
+        end = None if until is None else beats_to_ticks(until, self.ppq)
+        self._origin = loop.time() + self.lookahead  # tick 0 fires straight away
+        self._running = True
+        if self.raga is not None:
+            self.raga.mmcmidi()
+        for player in self.players:
+            self._push(0, PLAYER, player)
+
+        timers = self._timers
+        try:
+            while self._running and timers:
+                tick = timers[0][0]
+                if end is not None and tick >= end:
+                    break
+                due = self.time_of(tick) - self.lookahead
+                delay = due - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    if not self._running:
+                        break
+                lateness = loop.time() - due
+                if lateness > self.late_threshold:
+                    self.violation(tick, lateness, "timer")
+
+                self.now = tick
+                metrics.get_metrics().set("beat", tick // self.ppq)
+                # everything due on this tick, moods first
+                while timers and timers[0][0] == tick:
+                    _, kind, _, payload = heapq.heappop(timers)
+                    if kind == MOOD:
+                        log.info("event name=%s", payload.name)
+                        self.notify(payload)
+                    else:
+                        self._push(self.perform(payload, tick), PLAYER, payload)
+                        # between phrases, let the outputs send anything due
+                        await asyncio.sleep(0)
+        finally:
+            self._running = False
+        for output in self.outputs.values():
+            await output.flush()
+
+    async def close(self):
+        for output in self.outputs.values():
+            await output.close()
+
+
+async def perform(schedule, players, until=80, raga=None, **kwargs):
+    # Run a schedule with players (Player(None, ...)) for `until` beats
+    band = AsyncConductor(schedule, raga=raga, **kwargs)
+    for player in players:
+        band.addplayer(player)
+    try:
+        await band.run(until)
+    finally:
+        await band.close()
+    return band
+
+
+if __name__ == "__main__":
+    from bhairav import raga_bhairav
+    from player import default_participation, default_rules, default_schedule
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+    raga = raga_bhairav
+    beat = 60 / raga.bpm
+    player = Player(
+        None,
+        name="Sitarist",
+        participation=default_participation,
+        rules=default_rules(beat),
+        raga=raga,
+    )
+    asyncio.run(perform(default_schedule(), [player], until=80, raga=raga))
@@ -0,0 +1,211 @@
+# Batch rendering: many seeded performances of one raga across a process pool.
+# Each worker renders offline (no clock, no MIDI port) and writes its file.
+import argparse
+import copy
+import importlib
+import io
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import ragafile
+from cache import RenderCache, stable_hash
+from main import Raga
+from player import default_rules, default_schedule, scheduledevent
+from render import render_performance
+from templates import RENDER_VERSION
+
+
+def load_object(spec, kind=None):
+    # "module:attribute", or just "module" to take the first `kind` in it
+    module_name, _, attribute = spec.partition(":")
+    module = importlib.import_module(module_name)
+    if attribute:
+        return getattr(module, attribute)
+    for value in vars(module).values():
+        if kind is not None and isinstance(value, kind):
+            return value
+    raise ValueError(f"No {kind.__name__ if kind else 'object'} found in {spec!r}")
+
+
+def load_schedule(path):
+    # A JSON list of {"name": ..., "time": beats, "mood": ...}
+    with open(path) as f:
+        return [
+            scheduledevent(item["name"], item["time"], item["mood"])
+            for item in json.load(f)
+        ]
+
+
+def parse_seeds(text):
+    # "0-99", "7" or "1,5,9"
+    seeds = []
+    for part in text.split(","):
+        first, _, last = part.partition("-")
+        if last:
+            seeds.extend(range(int(first), int(last) + 1))
+        else:
+            seeds.append(int(first))
+    return seeds
+
+
+def rule_key(rule):
+    # Functions are identified by where they are defined; rule objects, as
+    # raga files hold, by their class and parameters
+    if hasattr(rule, "__qualname__"):
+        return f"{rule.__module__}.{rule.__qualname__}"
+    cls = type(rule)
+    return f"{cls.__module__}.{cls.__qualname__}:{stable_hash(vars(rule))}"
+
+
+def rules_key(rules):
+    return tuple(sorted((name, rule_key(rule)) for name, rule in rules.items()))
+
+
+def performance_key(raga, schedule, until, rules_spec, seed):
+    return (
+        "performance",
+        RENDER_VERSION,
+        raga.fingerprint,
+        raga.library_fingerprint,
+        # settings rules read besides the fingerprinted ones
+        (raga.tal, raga.bpm, raga.ppq, raga.channel),
+        rules_key(raga.rules),
+        rules_spec,
+        tuple((item.name, item.time, item.mood) for item in schedule),
+        until,
+        seed,
+    )
+
+
+_file_ragas = {}
+
+
+def load_raga(spec):
+    # A raga file (see ragafile), or a module spec as for load_object
+    if spec.endswith(ragafile.EXTENSIONS):
+        raga = _file_ragas.get(spec)
+        if raga is None:
+            raga = _file_ragas[spec] = ragafile.load_raga(spec)
+        return raga
+    return load_object(spec, Raga)
+
+
+def render_midi(raga_spec, seed, schedule=None, until=80, rules_spec=None):
+    # The performance as a MidiFile; mood rules are written to a copy
+    raga = copy.copy(load_raga(raga_spec))
+    raga.rules = dict(raga.rules)
+    beat = 60 / raga.bpm
+    rules = load_object(rules_spec)(beat) if rules_spec else default_rules(beat)
+    schedule = schedule if schedule is not None else default_schedule()
+    return render_performance(
+        raga, schedule=schedule, rules=rules, until=until, seed=seed
+    )
+
+
+def render_bytes(
+    raga_spec, seed, schedule=None, until=80, rules_spec=None, cache_dir=None
+):
+    # A (seed, config) pair always renders the same file, so finished renders
+    # can be reused from a cache directory shared by every worker
+    schedule = schedule if schedule is not None else default_schedule()
+    cache = RenderCache(maxsize=0, directory=cache_dir) if cache_dir else None
+    if cache is not None:
+        key = performance_key(load_raga(raga_spec), schedule, until, rules_spec, seed)
+        data = cache.get(key)
+        if data is not None:
+            return data
+
+    buffer = io.BytesIO()
+    render_midi(raga_spec, seed, schedule, until, rules_spec).save(file=buffer)
+    if cache is not None:
+        cache.put(key, buffer.getvalue())
+    return buffer.getvalue()
+
+
+def render_seed(
+    raga_spec,
+    seed,
+    out_dir,
+    schedule=None,
+    until=80,
+    rules_spec=None,
+    cache_dir=None,
+):
+    # Runs in a worker process
+    name = load_raga(raga_spec).name.lower()
+    path = os.path.join(out_dir, f"{name}_{seed:05d}.mid")
+    data = render_bytes(raga_spec, seed, schedule, until, rules_spec, cache_dir)
+    with open(path, "wb") as f:
+        f.write(data)
+    return seed, path
+
+
+def render_batch(
+    raga_spec,
+    seeds,
+    out_dir,
+    schedule=None,
+    until=80,
+    rules_spec=None,
+    workers=None,
+    cache_dir=None,
+):
+    # Yields (seed, path) as each file is finished, in completion order
+    os.makedirs(out_dir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(
+                render_seed,
+                raga_spec,
+                seed,
+                out_dir,
+                schedule,
+                until,
+                rules_spec,
+                cache_dir,
+            )
+            for seed in seeds
+        ]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render seeded raga performances")
+    parser.add_argument(
+        "--raga",
+        default="bhairav",
+        help="module or module:attribute of a Raga, or a raga file",
+    )
+    parser.add_argument("--seeds", default="0-9", help='e.g. "0-99" or "1,5,9"')
+    parser.add_argument("--out", default="renders", help="output directory")
+    parser.add_argument("--schedule", help="JSON file of scheduled events")
+    parser.add_argument(
+        "--rules", help="module:function taking the beat length, returning mood rules"
+    )
+    parser.add_argument("--beats", type=float, default=80, help="length in beats")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--cache", help="directory to reuse finished renders from")
+    args = parser.parse_args(argv)
+
+    schedule = load_schedule(args.schedule) if args.schedule else None
+    seeds = parse_seeds(args.seeds)
+    for done, (seed, path) in enumerate(
+        render_batch(
+            args.raga,
+            seeds,
+            args.out,
+            schedule=schedule,
+            until=args.beats,
+            rules_spec=args.rules,
+            workers=args.workers,
+            cache_dir=args.cache,
+        ),
+        1,
+    ):
+        print(f"[{done}/{len(seeds)}] seed {seed} -> {path}")
+
+
+if __name__ == "__main__":
+    main()
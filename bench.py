@@ -0,0 +1,257 @@
+# Benchmarks for the hot paths: phrase generation, phrase selection, velocity
+# shaping, wobble curves and deadline playback. Everything runs against a
+# capture or null backend, so no MIDI port is needed. Results are JSON.
+import argparse
+import json
+import platform
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+
+import mido
+
+import bhairav
+import variation
+from main import Raga, add_wobble, sequence_events
+from outputs import CaptureBackend, NullBackend
+from rng import make_rng
+
+BACKENDS = {"capture": CaptureBackend, "null": NullBackend}
+
+
+def timed(fn, repeat):
+    # Seconds per call of fn(), best of three runs of `repeat` calls
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        elapsed = (time.perf_counter() - start) / repeat
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def allocations(fn, repeat):
+    # Peak bytes allocated and memory blocks kept alive per call (tracemalloc)
+    tracemalloc.start()
+    try:
+        fn()  # warm any caches first
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        for _ in range(repeat):
+            fn()
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    blocks = sum(
+        stat.count_diff
+        for stat in after.compare_to(before, "filename")
+        if stat.count_diff > 0
+    )
+    return {
+        "peak_bytes_per_call": (peak - base) / repeat,
+        "retained_blocks_per_call": blocks / repeat,
+    }
+
+
+def make_raga(library_size=None, seed=0):
+    # A Bhairav with its own library, so nothing here touches raga_bhairav
+    raga = Raga(
+        "Bhairav",
+        bhairav.scale_arohana,
+        bhairav.scale_avarohana,
+        tal=bhairav.raga_bhairav.tal,
+        bpm=bhairav.raga_bhairav.bpm,
+        rules=dict(bhairav.bhairav_rules),
+        meendhMap=bhairav.meendhMap,
+        step_frequencies=bhairav.bhairav_step_frequencies,
+    )
+    for phrase in bhairav.raga_bhairav.phrases:
+        raga.add_phrase(phrase)
+    rng = make_rng(seed, "bench", "library")
+    while library_size is not None and len(raga.phrases) < library_size:
+        raga.add_phrase(variation.generate_random_phrase(rng.randint(3, 6), rng))
+    raga.seed(seed, "bench")
+    return raga
+
+
+def bench_generation(repeat):
+    raga = make_raga()
+    phrases = raga.phrases
+    state = {"i": 0}
+    events = sum(
+        len(phrase.get_midi_sequence(raga, 0, 1.0, 64)[0]) for phrase in phrases
+    ) / len(phrases)
+
+    def render():
+        phrase = phrases[state["i"] % len(phrases)]
+        state["i"] += 1
+        phrase.get_midi_sequence(raga, state["i"] % 2 * 7, 1.0, 64)
+
+    per_phrase = timed(render, repeat)
+    result = {
+        "phrases_per_sec": 1 / per_phrase,
+        "events_per_sec": events / per_phrase,
+        "events_per_phrase": events,
+    }
+    result.update(allocations(render, min(repeat, 500)))
+
+    # compose is the whole path: rules, selection, rendering and velocities
+    per_compose = timed(raga.compose, max(1, repeat // 10))
+    result["compose_per_sec"] = 1 / per_compose
+    return result
+
+
+def bench_selection(sizes, repeat):
+    results = []
+    for size in sizes:
+        raga = make_raga(size)
+        params = {"raga": raga, "base_duration": 1.0, "rng": raga.rng}
+        rule = bhairav.bhairav_phrase_selection_rule
+
+        start = time.perf_counter()
+        rule(params)  # builds the tal index for this library
+        build = time.perf_counter() - start
+        results.append(
+            {
+                "library_size": len(raga.phrases),
+                "index_build_sec": build,
+                "select_sec": timed(lambda: rule(params), repeat),
+            }
+        )
+    return results
+
+
+def bench_velocity(repeat):
+    raga = make_raga()
+    base_velocity, _, phrase_velocity, _ = raga.get_rules()
+    sequence, _ = raga.compose()
+    notes = sum(msg.type == "note_on" for msg in sequence)
+    result = {}
+    for name, rule in (
+        ("vectorized", base_velocity),
+        ("per_note", lambda params: base_velocity(params)),  # hides the flag
+    ):
+        per_call = timed(
+            lambda: raga.getvelocities(rule, phrase_velocity, sequence), repeat
+        )
+        result[name] = {
+            "sequences_per_sec": 1 / per_call,
+            "notes_per_sec": notes / per_call,
+        }
+    return result
+
+
+def bench_wobble(repeat):
+    frequencies = bhairav.bhairav_step_frequencies
+    result = {}
+    for shape in ("square", "sine"):
+        messages = len(add_wobble(3, 1.0, frequencies, shape=shape))
+        per_call = timed(lambda: add_wobble(3, 1.0, frequencies, shape=shape), repeat)
+        result[shape] = {
+            "curves_per_sec": 1 / per_call,
+            "messages_per_sec": messages / per_call,
+        }
+    return result
+
+
+def busy(stop):
+    # Background load: compose phrases as fast as possible until stopped
+    raga = make_raga()
+    while not stop.is_set():
+        raga.compose()
+
+
+def bench_jitter(backend, seconds, rate, load):
+    # Evenly spaced notes for `seconds`, played with Raga.playmidi
+    raga = make_raga()
+    raga.output = BACKENDS[backend]()
+    gap = 1 / rate
+    sequence = []
+    for i in range(int(seconds * rate / 2)):
+        note = 60 + i % 12
+        sequence.append(mido.Message("note_on", note=note, velocity=64, time=gap))
+        sequence.append(mido.Message("note_off", note=note, velocity=0, time=gap))
+
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=busy, args=(stop,), daemon=True) for _ in range(load)
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        stats = raga.playmidi(sequence)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    summary = stats.summary()
+    summary["load_threads"] = load
+    summary["scheduled_events"] = len(sequence_events(sequence))
+    if stats.jitter:
+        summary["mean"] = statistics.fmean(stats.jitter)
+    return summary
+
+
+def run(
+    repeat=2000,
+    sizes=(10, 100, 1000),
+    backend="capture",
+    seconds=2.0,
+    rate=200,
+    loads=(0, 2),
+):
+    return {
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "generation": bench_generation(repeat),
+        "selection": bench_selection(sizes, repeat),
+        "velocity": bench_velocity(repeat),
+        "wobble": bench_wobble(max(1, repeat // 10)),
+        "jitter": [bench_jitter(backend, seconds, rate, load) for load in loads],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the raga hot paths")
+    parser.add_argument("--out", help="write the JSON results here instead of stdout")
+    parser.add_argument("--repeat", type=int, default=2000, help="calls per timing")
+    parser.add_argument(
+        "--sizes", default="10,100,1000", help="library sizes for selection latency"
+    )
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="capture")
+    parser.add_argument("--seconds", type=float, default=2.0, help="jitter run length")
+    parser.add_argument(
+        "--rate", type=float, default=200, help="jitter events per second"
+    )
+    parser.add_argument(
+        "--load", default="0,2", help="background composing threads for each jitter run"
+    )
+    parser.add_argument("--quick", action="store_true", help="small, fast run")
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        args.repeat, args.sizes, args.seconds = 100, "10,100", 0.5
+    results = run(
+        repeat=args.repeat,
+        sizes=[int(size) for size in args.sizes.split(",")],
+        backend=args.backend,
+        seconds=args.seconds,
+        rate=args.rate,
+        loads=[int(load) for load in args.load.split(",")],
+    )
+    text = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
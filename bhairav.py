@@ -1,4 +1,8 @@
 from main import *
+from rng import make_rng
+import numpy as np
+from selection import TalSelector
+import variation
 import random
 
 # Define the scales for Raga Bhairav
@@ -44,27 +48,28 @@ def bhairav_base_duration_rule(params):
     return snapped_duration
 
 
+@vectorized_rule
 def bhairav_base_velocity_rule(params):
-    note_index = params["note_index"]
-    total_notes = params["total_notes"]
     """
     A simple rule for setting the velocity of notes in the Bhairav Raga.
     This example increases velocity towards the middle of the phrase and then decreases it.
+    Works on one note index or an array of them.
     """
+    note_index = np.asarray(params["note_index"])
+    total_notes = params["total_notes"]
+
     midpoint = total_notes / 2
-    if note_index < midpoint:
-        # Increase velocity as we approach the middle
-        velocity = int(60 + (note_index / midpoint) * (127 - 60))
-    else:
-        # Decrease velocity as we move away from the middle
-        velocity = int(127 - ((note_index - midpoint) / midpoint) * (127 - 60))
+    # Increase velocity as we approach the middle
+    rising = 60 + (note_index / midpoint) * (127 - 60)
+    # Decrease velocity as we move away from the middle
+    falling = 127 - ((note_index - midpoint) / midpoint) * (127 - 60)
+    velocity = np.where(note_index < midpoint, rising, falling).astype(int)
 
-    velocity = int(velocity / 2)  # scale down velocity
-    return velocity
+    velocity = (velocity / 2).astype(int)  # scale down velocity
+    return velocity if velocity.ndim else int(velocity)
 
 
 def bhairav_phrase_velocity_rule(params):
-
     base_velocity = 64
 
     # Snap to the nearest 0.5
@@ -75,36 +80,22 @@ def bhairav_phrase_velocity_rule(params):
 
 def calculate_phrase_duration(phrase, base_duration):
     # Assuming each Note in a phrase has a 'duration' attribute
-    return sum(note.relative_duration for note in phrase.notes) * base_duration
+    return phrase.total_duration() * base_duration
 
 
 def bhairav_phrase_selection_rule(params):
-    tal = params["raga"].tal
-    bpm = params["raga"].bpm
+    raga = params["raga"]
     base_duration = params["base_duration"]
-    phrases = params["raga"].phrases
 
-    # Calculate the duration of each phrase
-    phrase_durations = [
-        calculate_phrase_duration(phrase, base_duration) for phrase in phrases
-    ]
-
-    # Attempt to find a combination of phrases that matches a low multiple of tal
-    for attempt in range(100):  # Arbitrary number of attempts to avoid infinite loop
-        selected_phrases = random.sample(phrases, 3) if len(phrases) > 3 else phrases
-        total_duration = sum(
-            phrase_durations[phrases.index(p)] for p in selected_phrases
-        )
-        beatduration = 60 / bpm
-        talduration = tal * beatduration
-
-        if (
-            total_duration % talduration == 0
-        ):  # Check if total duration is a multiple of tal
-            return selected_phrases
-
-    # Fallback if no combination is found
-    return phrases  # Or some other default behaviour
+    # Three phrases that together fill a whole number of tal cycles, drawn from
+    # an index that is only rebuilt when the phrase library changes
+    selector = raga.library_cache(
+        ("tal", raga.tal, raga.bpm, raga.ppq, base_duration),
+        lambda: TalSelector(
+            raga.phrases, raga.tal, raga.bpm, base_duration, ppq=raga.ppq
+        ),
+    )
+    return selector.sample(params.get("rng", random))
 
 
 # Usage
@@ -113,10 +104,9 @@ def bhairav_phrase_selection_rule(params):
 
 
 def bhairav_phrase_selection_rule_sentence_based(params):
-
-    num_phrases_index = params["phrase_index"]
-    num_phrases = params["total_phrases"]
     phrases = params["raga"].phrases
+    num_phrases_index = params.get("phrase_index", 0)
+    num_phrases = params.get("total_phrases", len(phrases))
 
     sentence = "Hello darkness my old friend"
     # If the sentence is longer than the number of phrases, truncate or repeat it
@@ -125,8 +115,7 @@ def bhairav_phrase_selection_rule_sentence_based(params):
 
     # Map the current character to a phrase
     char_index = ord(sentence[num_phrases_index % len(sentence)]) % len(phrases)
-    print(char_index)
-    return phrases[char_index]
+    return [phrases[char_index]]
 
 
 # Bhairav Raga rules
@@ -151,60 +140,12 @@ raga_bhairav = Raga(
 
 
 # Add phrases to Raga Bhairav
-def mutate_phrase(phrase):
-    mutated_notes = []
-
-    for note in phrase.notes:
-        # Randomly decide whether to mutate each aspect of the note
-        mutate_step = random.choice([True, False])
-        mutate_duration = random.choice([True, False])
-        mutate_meendh = random.choice([True, False])
+def mutate_phrase(phrase, rng=random):
+    return variation.mutate_phrase(phrase, list(meendhMap), rng)
 
-        new_step = note.increment
-        new_duration = note.relative_duration
-        new_meendh = note.meendh
 
-        # Mutate step
-        if mutate_step:
-            new_step += random.choice([-1, 0, 1])
-            new_step = max(-2, min(2, new_step))  # Keep within a range
-
-        # Mutate duration
-        if mutate_duration:
-            duration_choices = [0.25, 0.5, 0.75, 1, 1.25, 1.5]
-            new_duration = random.choice(duration_choices)
-
-        # Mutate meendh
-        if mutate_meendh:
-            meendh_choices = [None] + list(meendhMap)
-            new_meendh = random.choice(meendh_choices)
-
-        mutated_notes.append(Note(new_step, new_duration, new_meendh))
-
-    return Phrase(mutated_notes)
-
-
-def generate_random_phrase(num_notes):
-    notes = []
-
-    # Ensure the first note's step is always 0
-    step = 0
-    first_duration = random.choice([0.5, 1, 1.5])
-    notes.append(Note(step, first_duration))
-
-    # Generate the rest of the notes
-    for _ in range(1, num_notes):
-        # Adjust the probability of the next step based on the previous step
-        if step == 0:
-            step = random.choice([-1, 1])
-        else:
-            step = random.choice([step, step, step, -1, 0, 1])
-
-        duration = random.choice([0.25, 0.5, 0.75, 1, 1.25, 1.5]) * first_duration
-        meendh = random.choice([None, None, None, "updown", "updown"])
-        notes.append(Note(step, duration, meendh))
-
-    return Phrase(notes)
+def generate_random_phrase(num_notes, rng=random):
+    return variation.generate_random_phrase(num_notes, rng)
 
 
 phrase1 = Phrase([Note(0, 0.75, "updown"), Note(1, 0.75), Note(1, 1.5, "up")])
@@ -240,19 +181,23 @@ phrase5 = Phrase(
 )
 
 
+# The mutated library comes from a fixed stream so every import builds the same one
+LIBRARY_SEED = 0
+library_rng = make_rng(LIBRARY_SEED, "bhairav", "library")
+
 raga_bhairav.add_phrase(phrase2)
-raga_bhairav.add_phrase(mutate_phrase(phrase2))
-raga_bhairav.add_phrase(mutate_phrase(phrase2))
-raga_bhairav.add_phrase(mutate_phrase(phrase2))
-raga_bhairav.add_phrase(mutate_phrase(phrase2))
-raga_bhairav.add_phrase(mutate_phrase(phrase2))
+raga_bhairav.add_phrase(mutate_phrase(phrase2, library_rng))
+raga_bhairav.add_phrase(mutate_phrase(phrase2, library_rng))
+raga_bhairav.add_phrase(mutate_phrase(phrase2, library_rng))
+raga_bhairav.add_phrase(mutate_phrase(phrase2, library_rng))
+raga_bhairav.add_phrase(mutate_phrase(phrase2, library_rng))
 
 raga_bhairav.add_phrase(phrase3)
-raga_bhairav.add_phrase(mutate_phrase(phrase3))
-raga_bhairav.add_phrase(mutate_phrase(phrase3))
-raga_bhairav.add_phrase(mutate_phrase(phrase3))
-raga_bhairav.add_phrase(mutate_phrase(phrase3))
-raga_bhairav.add_phrase(mutate_phrase(phrase3))
+raga_bhairav.add_phrase(mutate_phrase(phrase3, library_rng))
+raga_bhairav.add_phrase(mutate_phrase(phrase3, library_rng))
+raga_bhairav.add_phrase(mutate_phrase(phrase3, library_rng))
+raga_bhairav.add_phrase(mutate_phrase(phrase3, library_rng))
+raga_bhairav.add_phrase(mutate_phrase(phrase3, library_rng))
 
 raga_bhairav.add_phrase(phrase5)
 
@@ -0,0 +1,84 @@
+# Content-addressed render cache. Keys are tuples of plain values describing
+# everything an output depends on; a bounded LRU sits in memory and an optional
+# directory holds pickled values across runs.
+import hashlib
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+
+def stable_hash(value):
+    # Same digest in every process, unlike hash()
+    return hashlib.sha256(repr(value).encode()).hexdigest()
+
+
+class RenderCache:
+    def __init__(self, maxsize=1024, directory=None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _path(self, key):
+        return os.path.join(self.directory, stable_hash(key) + ".pickle")
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+
+        if self.directory is not None:
+            try:
+                with open(self._path(key), "rb") as f:
+                    value = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                pass
+            else:
+                self.disk_hits += 1
+                self._remember(key, value)
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return default
+
+    def put(self, key, value):
+        self._remember(key, value)
+        if self.directory is not None:
+            # write then rename, so a reader never sees half a file
+            path = self._path(key)
+            partial = f"{path}.{os.getpid()}.{threading.get_ident()}"
+            with open(partial, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(partial, path)
+        return value
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+        }
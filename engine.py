@@ -0,0 +1,158 @@
+# One long-lived playback thread per output port. Every player submits its
+# timestamped events here and they go out merged in deadline order.
+import heapq
+import itertools
+import threading
+import time
+
+from metrics import get_metrics
+from scheduler import DeadlineScheduler, JitterStats
+
+
+class PlaybackEngine:
+    def __init__(
+        self,
+        output,
+        late_policy="catchup",
+        spin=0.002,
+        late_threshold=0.02,
+        clock=time.perf_counter,
+    ):
+        self.output = output
+        self.scheduler = DeadlineScheduler(
+            output,
+            late_policy=late_policy,
+            spin=spin,
+            late_threshold=late_threshold,
+            clock=clock,
+        )
+        self.clock = clock
+        self.stats = JitterStats()
+        self._queue = []  # heap of (deadline, submission order, message)
+        self._order = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+        self._inflight = 0
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(
+                target=self._run, name="playback-engine", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        # Stops the worker; anything still queued is cleared first
+        self.clear()
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+            thread = self._thread
+            self._thread = None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def submit(self, events, start=None):
+        # events are (offset in seconds, message) pairs relative to start
+        start = self.clock() if start is None else start
+        with self._cond:
+            for offset, msg in events:
+                heapq.heappush(self._queue, (start + offset, next(self._order), msg))
+            get_metrics().set("playback_queue_depth", len(self._queue))
+            self._cond.notify_all()
+        self.start()
+
+    def submit_many(self, batch):
+        # batch is [(events, start), ...], e.g. every voice due on one tick;
+        # they are merged into the queue under a single lock
+        now = self.clock()
+        with self._cond:
+            for events, start in batch:
+                start = now if start is None else start
+                self._queue.extend(
+                    (start + offset, next(self._order), msg) for offset, msg in events
+                )
+            heapq.heapify(self._queue)
+            get_metrics().set("playback_queue_depth", len(self._queue))
+            self._cond.notify_all()
+        self.start()
+
+    def flush(self, timeout=None):
+        # Blocks until every queued event has been sent
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self._queue and not self._inflight, timeout
+            )
+
+    def clear(self):
+        # Drops pending events, but still sends their note_offs so nothing hangs
+        with self._cond:
+            pending = [msg for _, _, msg in sorted(self._queue)]
+            self._queue = []
+            self._cond.notify_all()
+        for msg in pending:
+            if msg.type == "note_off":
+                self.output.send(msg)
+
+    def pending(self):
+        with self._cond:
+            return len(self._queue)
+
+    def _run(self):
+        scheduler = self.scheduler
+        while True:
+            with self._cond:
+                while self._running and not self._queue:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                deadline = self._queue[0][0]
+                remaining = deadline - self.clock()
+                if remaining > scheduler.spin:
+                    # an earlier event may be submitted meanwhile, so look again
+                    self._cond.wait(remaining - scheduler.spin)
+                    continue
+
+            scheduler.wait_until(deadline)
+
+            with self._cond:
+                due = []
+                now = self.clock()
+                while self._queue and self._queue[0][0] <= now:
+                    due.append(heapq.heappop(self._queue))
+                self._inflight = len(due)
+                get_metrics().set("playback_queue_depth", len(self._queue))
+
+            for deadline, _, msg in due:
+                scheduler.send_due(deadline, msg, self.stats)
+
+            with self._cond:
+                self._inflight = 0
+                if not self._queue:
+                    self._cond.notify_all()
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(output, **kwargs):
+    # Shared engine for an output; kwargs only apply when it is first created
+    with _engines_lock:
+        engine = _engines.get(id(output))
+        if engine is None or engine.output is not output:
+            engine = PlaybackEngine(output, **kwargs)
+            _engines[id(output)] = engine
+        return engine
+
+
+def stop_all():
+    with _engines_lock:
+        engines = list(_engines.values())
+        _engines.clear()
+    for engine in engines:
+        engine.stop()
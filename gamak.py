@@ -0,0 +1,156 @@
+# Gamak and pitch curves. Bend values per scale step are worked out once per
+# raga, and vibrato/glide curves are generated with NumPy at a control rate.
+import math
+
+import mido
+import numpy as np
+
+MAX_BEND = 8191
+MIN_BEND = -8192
+SHAPES = ("square", "sine", "triangle", "ramp")
+GLIDE_SHAPES = ("linear", "ease", "exp")
+
+
+def semitones_to_bend(semitones, max_bend=MAX_BEND, octave=12):
+    # The synth's bend range is taken to be one octave either way
+    return int(semitones / octave * max_bend)
+
+
+class BendTable:
+    """Pitch bend value for every step in a raga's step_frequencies."""
+
+    def __init__(self, step_frequencies, max_bend=MAX_BEND, octave=12):
+        self.max_bend = max_bend
+        self.semitones = {
+            step: 12 * math.log2(ratio) for step, ratio in step_frequencies.items()
+        }
+        self.scale_length = sum(1 for step in step_frequencies if step >= 0)
+        self.bends = {
+            step: semitones_to_bend(semitones, max_bend, octave)
+            for step, semitones in self.semitones.items()
+        }
+
+    def __contains__(self, step):
+        return step in self.bends
+
+    def bend(self, step):
+        bend = self.bends.get(step)
+        if bend is None:
+            raise ValueError("Invalid scale step")
+        return bend
+
+    def step_semitones(self, step):
+        # Steps outside the table are taken from the octave above or below
+        semitones = self.semitones.get(step)
+        if semitones is None and self.scale_length:
+            octave_shift, index = divmod(step, self.scale_length)
+            if index in self.semitones:
+                semitones = self.semitones[index] + 12 * octave_shift
+        return semitones
+
+    def interval(self, step, step_delta, octave=12):
+        # Bend needed to move from one step to another while holding a note
+        semitones = self.step_semitones(step)
+        target = self.step_semitones(step + step_delta)
+        if semitones is None or target is None:
+            raise ValueError("Invalid scale step")
+        return semitones_to_bend(target - semitones, self.max_bend, octave)
+
+
+_tables = {}
+
+
+def bend_table(step_frequencies, max_bend=MAX_BEND):
+    # Shared tables for callers that only have the step_frequencies dict
+    key = (id(step_frequencies), max_bend)
+    cached = _tables.get(key)
+    if cached is None or cached[0] is not step_frequencies:
+        cached = (step_frequencies, BendTable(step_frequencies, max_bend))
+        _tables[key] = cached
+    return cached[1]
+
+
+def curve(shape, duration, depth, rate=6, control_rate=100):
+    """
+    Bend offsets and the delay after each, as two arrays.
+
+    "square" alternates +depth/-depth every half cycle of `rate` (the original
+    wobble); "sine" and "triangle" are vibratos sampled at `control_rate` Hz;
+    "ramp" glides linearly from 0 to depth across the duration.
+    """
+    if shape == "square":
+        cycles = int(duration * rate)
+        half = 1 / (2 * rate)
+        offsets = np.tile(np.array([depth, -depth, 0]), cycles)
+        delays = np.tile(np.array([half, half, 0.0]), cycles)
+        return offsets, delays
+
+    if shape not in SHAPES:
+        raise ValueError(f"Unknown curve shape {shape!r}")
+
+    samples = max(1, int(duration * control_rate))
+    delays = np.full(samples, duration / samples)
+    if shape == "ramp":
+        offsets = np.linspace(0, depth, samples)
+    else:
+        phase = 2 * np.pi * rate * np.arange(samples) * (duration / samples)
+        if shape == "sine":
+            offsets = depth * np.sin(phase)
+        else:
+            offsets = depth * (2 / np.pi) * np.arcsin(np.sin(phase))
+    return offsets, delays
+
+
+def curve_messages(base_bend, offsets, delays):
+    bends = np.clip(np.rint(base_bend + offsets), MIN_BEND, MAX_BEND).astype(int)
+    return [
+        mido.Message("pitchwheel", pitch=pitch, time=delay)
+        for pitch, delay in zip(bends.tolist(), delays.tolist())
+    ]
+
+
+def wobble_messages(
+    table, target_step, duration, depth=500, rate=6, shape="square", control_rate=100
+):
+    offsets, delays = curve(shape, duration, depth, rate, control_rate)
+    messages = curve_messages(table.bend(target_step), offsets, delays)
+    # The wobble stands in for the note's duration, so it must last exactly
+    # that long; whole cycles rarely do, so the final reset takes up the rest
+    remainder = max(0.0, duration - float(delays.sum()))
+    if shape == "square" and messages:
+        # the square wobble already ends each cycle back at zero
+        messages[-1].time += remainder
+    else:
+        messages.append(mido.Message("pitchwheel", pitch=0, time=remainder))
+    return messages
+
+
+def glide_fractions(steps, shape="linear"):
+    # How far through the glide each of the ramp's steps lands, ending at 1
+    x = np.arange(1, steps + 1) / steps
+    if shape == "linear":
+        return x
+    if shape == "ease":
+        return (1 - np.cos(np.pi * x)) / 2
+    if shape == "exp":
+        return np.expm1(3 * x) / np.expm1(3)
+    raise ValueError(f"Unknown glide shape {shape!r}")
+
+
+def glide_messages(
+    table, step, step_delta, duration, steps=10, shape="linear", hold=0.5, start_bend=0
+):
+    """
+    A meendh glide as pitchwheel messages lasting `duration` seconds.
+
+    Holds start_bend for the first `hold` fraction of the duration, then ramps
+    in `steps` steps to the bend that reaches step + step_delta.
+    """
+    target_bend = start_bend + table.interval(step, step_delta)
+    ramp_time = duration * (1 - hold)
+    offsets = start_bend + (target_bend - start_bend) * glide_fractions(steps, shape)
+    delays = np.full(steps, ramp_time / steps)
+
+    messages = [mido.Message("pitchwheel", pitch=start_bend, time=duration * hold)]
+    messages += curve_messages(0, offsets, delays)
+    return messages
@@ -0,0 +1,102 @@
+# Look-ahead composition. A worker thread keeps the next few phrases of a raga
+# composed so a phrase boundary only has to take one off the buffer.
+import threading
+from collections import deque
+
+
+class PhraseBuffer:
+    """
+    Keeps up to `depth` composed (midi_sequence, ticks) pairs ready.
+
+    invalidate() drops everything buffered, optionally after changing the
+    raga's rules, so nothing composed under the old rules is ever played.
+    If composing raises, the worker stops and get() re-raises the error once
+    the phrases before it are used up; the next get() starts a new worker.
+    """
+
+    def __init__(self, raga, depth=2):
+        self.raga = raga
+        self.depth = depth
+        self.generation = 0
+        self._buffer = deque()
+        self._cond = threading.Condition()
+        # held while composing, so rules never change halfway through a phrase
+        self._compose_lock = threading.Lock()
+        self._thread = None
+        self._running = False
+        self._error = None  # what stopped the worker, until get() raises it
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(
+                target=self._run, name="phrase-buffer", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            thread.join()
+
+    def get(self, timeout=None):
+        # The next composed phrase; only waits if the worker has fallen behind
+        self.start()
+        with self._cond:
+            ready = self._cond.wait_for(
+                lambda: self._buffer or self._error is not None, timeout
+            )
+            if not ready:
+                raise TimeoutError("No phrase composed in time")
+            if not self._buffer:
+                error, self._error = self._error, None
+                raise error
+            composed = self._buffer.popleft()
+            self._cond.notify_all()
+            return composed
+
+    def invalidate(self, update=None):
+        # update() runs with composing paused, e.g. to write new mood rules
+        with self._compose_lock:
+            if update is not None:
+                update()
+            with self._cond:
+                self.generation += 1
+                self._buffer.clear()
+                self._cond.notify_all()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._buffer)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: not self._running or len(self._buffer) < self.depth
+                )
+                if not self._running:
+                    return
+
+            with self._compose_lock:
+                generation = self.generation
+                try:
+                    composed = self.raga.compose()
+                except Exception as e:
+                    with self._cond:
+                        self._error = e
+                        self._running = False
+                        self._thread = None
+                        self._cond.notify_all()
+                    return
+
+            with self._cond:
+                if generation == self.generation:
+                    self._buffer.append(composed)
+                    self._cond.notify_all()
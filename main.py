@@ -1,13 +1,38 @@
+import copy
+import logging
 import mido
+import numpy as np
 import random
 import time
-import threading
+import weakref
+from collections.abc import Sequence
 
+from cache import stable_hash
+from engine import get_engine
+from gamak import BendTable, bend_table, glide_messages, wobble_messages
+from metrics import get_metrics
+from outputs import get_output
+from rng import make_rng
+from scheduler import DeadlineScheduler
+from similarity import PhraseIndex
+from templates import KeyswitchMessage, compile_phrase
+from timing import PPQ, seconds_to_ticks, ticks_to_seconds
 
-OUTPORT = mido.open_output("loopMIDI Port 4")
+log = logging.getLogger("raga")
+
+RECENT_PHRASES = 4  # selections rules see as params["previous_phrases"]
+
+
+def vectorized_rule(rule):
+    # Marks a base_velocity_rule that accepts an array of note indices in
+    # params["note_index"] and returns an array of velocities
+    rule.vectorized = True
+    return rule
 
 
 class Note:
+    __slots__ = ("increment", "relative_duration", "meendh")
+
     def __init__(self, increment=0, relative_duration=1, meendh=None):
         self.increment = increment  # increment (in scale steps) from the starting note
         self.relative_duration = relative_duration
@@ -15,65 +40,328 @@ class Note:
 
 
 class Phrase:
+    # Either holds its own list of Notes or is a view of one phrase stored in
+    # a PhraseLibrary
+    __slots__ = ("_notes", "_library", "_index", "__weakref__")
+
     def __init__(self, notes):
-        self.notes = notes
+        self._notes = notes
+        self._library = None
+        self._index = None
+
+    @classmethod
+    def view(cls, library, index):
+        phrase = cls.__new__(cls)
+        phrase._notes = None
+        phrase._library = library
+        phrase._index = index
+        return phrase
+
+    @property
+    def notes(self):
+        # A view builds its Notes on demand; changing them does not write back
+        if self._library is not None:
+            return self._library.notes(self._index)
+        return self._notes
+
+    @notes.setter
+    def notes(self, notes):
+        self._notes = notes
+        self._library = None
+        self._index = None
+
+    def columns(self):
+        # (increments, relative durations, meendh names), the first two as arrays
+        if self._library is not None:
+            return self._library.columns(self._index)
+        notes = self._notes
+        return (
+            np.array([note.increment for note in notes], dtype=np.int64),
+            np.array([note.relative_duration for note in notes], dtype=np.float64),
+            [note.meendh for note in notes],
+        )
+
+    def total_duration(self):
+        # Sum of the relative durations
+        if self._library is not None:
+            return self._library.total_duration(self._index)
+        return sum(note.relative_duration for note in self._notes)
 
     def get_scale_type(self):
-        net_movement = sum(note.increment for note in self.notes)
+        if self._library is not None:
+            net_movement = self._library.net_movement(self._index)
+        else:
+            net_movement = sum(note.increment for note in self._notes)
         return "arohana" if net_movement >= 0 else "avarohana"
 
+    def key(self):
+        # Everything about the phrase that affects what it renders to
+        if self._library is not None:
+            return self._library.key(self._index)
+        return tuple(
+            (note.increment, note.relative_duration, note.meendh)
+            for note in self._notes
+        )
+
+    def compile(self, raga, start_scale_step=0):
+        return raga.template(self, start_scale_step)
+
     def get_midi_sequence(self, raga, start_scale_step=0, base_duration=1, velocity=64):
-        scale_type = self.get_scale_type()
-        scale = raga.arohana if scale_type == "arohana" else raga.avarohana
+        # Returns the messages and the phrase length in ticks
+        template = raga.template(self, start_scale_step)
+        wobble_mask = tuple(raga.rng.random() > 0.5 for _ in range(len(template)))
+        base_ticks = raga.seconds_to_ticks(base_duration)
+
+        cache = raga.cache
+        if cache is not None:
+            # the wobble draws are part of the key, so seeded runs hit too
+            key = (template.key, base_ticks, velocity, wobble_mask)
+            cached = cache.get(key)
+            if cached is not None:
+                midi_sequence, phrase_ticks = cached
+                return [msg.copy() for msg in midi_sequence], phrase_ticks
+
+        midi_sequence, phrase_ticks = template.render(
+            base_ticks,
+            velocity,
+            raga.ticks_to_seconds(1),
+            wobble_mask,
+            lambda i, actual_duration: raga.add_wobble(0, actual_duration),
+            lambda i, actual_duration: raga.add_glide(
+                int(template.steps[i]), int(template.glides[i]), actual_duration
+            ),
+        )
 
-        midi_sequence = []
-        current_position = start_scale_step
-        total_length = 0
-
-        for note in self.notes:
-            current_position += note.increment
-            octave_shift = current_position // len(scale)
-            note_index = current_position % len(scale)
-            midi_note = scale[note_index] + (12 * octave_shift)
-            actual_duration = note.relative_duration * base_duration
-
-            meendth = note.meendh
-            keysw = (
-                raga.meendhMap[meendth] if meendth in raga.meendhMap else None
-            )  # need to check this
-
-            wobble_sequence = add_wobble(0, actual_duration, raga.step_frequencies)
-            wobble = random.random() > 0.5
-
-            if wobble:
-                midi_sequence.append(mido.Message("note_on", note=midi_note))
-                midi_sequence += wobble_sequence
-            elif keysw:
-                midi_sequence.append(mido.Message("note_on", note=keysw))
-                midi_sequence.append(
-                    mido.Message(
-                        "note_on",
-                        note=midi_note,
-                        velocity=velocity,
-                        time=actual_duration,
-                    )
-                )
-                midi_sequence.append(
-                    mido.Message("note_off", note=keysw)
-                )  # move this up to other function
-            else:
-                midi_sequence.append(
-                    mido.Message(
-                        "note_on",
-                        note=midi_note,
-                        velocity=velocity,
-                        time=actual_duration,
-                    )
-                )
-            midi_sequence.append(mido.Message("note_off", note=midi_note))
-            total_length += actual_duration
+        if cache is not None:
+            # getvelocities changes messages in place, so keep our own copies
+            cache.put(key, ([msg.copy() for msg in midi_sequence], phrase_ticks))
+        return midi_sequence, phrase_ticks
+
+
+class PhraseLibrary(Sequence):
+    """
+    Phrases stored as parallel typed arrays, one entry per note (increment,
+    relative duration, meendh code), with each phrase's offset into them.
+
+    Items are Phrase views. Library-wide questions such as lengths, scale
+    types and filters are array scans instead of loops over Note objects.
+    """
+
+    def __init__(self, phrases=()):
+        self.meendhs = [None]  # meendh code -> name; 0 is no meendh
+        self._codes = {None: 0}
+        self._increments = np.empty(16, dtype=np.int16)
+        self._durations = np.empty(16, dtype=np.float64)
+        self._meendh_codes = np.empty(16, dtype=np.uint8)
+        self._offsets = np.zeros(16, dtype=np.int64)
+        self._size = 0  # notes stored
+        self._count = 0  # phrases stored
+        self._views = weakref.WeakValueDictionary()
+        self.extend(phrases)
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("phrase index out of range")
+        # the same view comes back while anyone holds it, so caches keyed
+        # by id(phrase) keep working
+        view = self._views.get(index)
+        if view is None:
+            view = self._views[index] = Phrase.view(self, index)
+        return view
+
+    def index(self, phrase, start=0, stop=None):
+        # A view knows its own position; anything else is looked for by notes
+        stop = self._count if stop is None else min(stop, self._count)
+        if getattr(phrase, "_library", None) is self and start <= phrase._index < stop:
+            return phrase._index
+        key = phrase.key()
+        for i in range(start, stop):
+            if self.key(i) == key:
+                return i
+        raise ValueError("phrase is not in the library")
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_views"] = dict(self._views)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._views = weakref.WeakValueDictionary(self._views)
+
+    def meendh_codes_for(self, meendhs):
+        codes = []
+        for meendh in meendhs:
+            code = self._codes.get(meendh)
+            if code is None:
+                if len(self.meendhs) > np.iinfo(np.uint8).max:
+                    raise ValueError("Too many distinct meendhs for one library")
+                code = self._codes[meendh] = len(self.meendhs)
+                self.meendhs.append(meendh)
+            codes.append(code)
+        return np.array(codes, dtype=np.uint8)
+
+    def _reserve(self, notes, phrases):
+        # grow the backing arrays geometrically so appends stay amortised O(1)
+        for name, needed in (
+            ("_increments", self._size + notes),
+            ("_durations", self._size + notes),
+            ("_meendh_codes", self._size + notes),
+            ("_offsets", self._count + phrases + 1),
+        ):
+            array = getattr(self, name)
+            if needed > len(array):
+                grown = np.zeros(max(needed, 2 * len(array)), dtype=array.dtype)
+                grown[: len(array)] = array
+                setattr(self, name, grown)
+
+    def extend_arrays(self, increments, durations, meendh_codes, lengths):
+        # Append many phrases at once: flat note arrays plus notes per phrase
+        lengths = np.asarray(lengths, dtype=np.int64)
+        notes = int(lengths.sum())
+        if not len(increments) == len(durations) == len(meendh_codes) == notes:
+            raise ValueError("Note arrays and phrase lengths do not match")
+        if len(meendh_codes) and int(np.max(meendh_codes)) >= len(self.meendhs):
+            raise ValueError("Unknown meendh code")
+        self._reserve(notes, len(lengths))
+        size, count = self._size, self._count
+        self._increments[size : size + notes] = increments
+        self._durations[size : size + notes] = durations
+        self._meendh_codes[size : size + notes] = meendh_codes
+        self._offsets[count + 1 : count + 1 + len(lengths)] = size + np.cumsum(lengths)
+        self._size += notes
+        self._count += len(lengths)
+
+    def append(self, phrase):
+        increments, durations, meendhs = phrase.columns()
+        self.extend_arrays(
+            increments, durations, self.meendh_codes_for(meendhs), [len(meendhs)]
+        )
+        return self[self._count - 1]
+
+    def extend(self, phrases):
+        if isinstance(phrases, PhraseLibrary):
+            # arrays straight across, with meendh codes translated to ours
+            codes = self.meendh_codes_for(phrases.meendhs)
+            self.extend_arrays(
+                phrases.increments,
+                phrases.durations,
+                codes[phrases.meendh_codes],
+                phrases.lengths(),
+            )
+            return
+        for phrase in phrases:
+            self.append(phrase)
+
+    @property
+    def increments(self):
+        return self._increments[: self._size]
+
+    @property
+    def durations(self):
+        return self._durations[: self._size]
+
+    @property
+    def meendh_codes(self):
+        return self._meendh_codes[: self._size]
+
+    @property
+    def offsets(self):
+        # phrase i is notes offsets[i]:offsets[i + 1]
+        return self._offsets[: self._count + 1]
+
+    @property
+    def nbytes(self):
+        return (
+            sum(
+                array.nbytes
+                for array in (self.increments, self.durations, self.meendh_codes)
+            )
+            + self.offsets.nbytes
+        )
 
-        return midi_sequence, total_length
+    def _span(self, index):
+        return int(self._offsets[index]), int(self._offsets[index + 1])
+
+    def columns(self, index):
+        start, end = self._span(index)
+        meendhs = self.meendhs
+        return (
+            self._increments[start:end].astype(np.int64),
+            self._durations[start:end].copy(),
+            [meendhs[code] for code in self._meendh_codes[start:end].tolist()],
+        )
+
+    def notes(self, index):
+        return [Note(*note) for note in self.key(index)]
+
+    def key(self, index):
+        start, end = self._span(index)
+        meendhs = self.meendhs
+        return tuple(
+            zip(
+                self._increments[start:end].tolist(),
+                self._durations[start:end].tolist(),
+                [meendhs[code] for code in self._meendh_codes[start:end].tolist()],
+            )
+        )
+
+    def total_duration(self, index):
+        start, end = self._span(index)
+        return sum(self._durations[start:end].tolist())
+
+    def net_movement(self, index):
+        start, end = self._span(index)
+        return int(self._increments[start:end].sum())
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def _per_phrase_sum(self, values):
+        totals = np.zeros(self._count, dtype=values.dtype)
+        if self._size:
+            starts = np.minimum(self.offsets[:-1], self._size - 1)
+            totals = np.add.reduceat(values, starts)
+            totals[self.lengths() == 0] = 0
+        return totals
+
+    def total_durations(self):
+        return self._per_phrase_sum(self.durations)
+
+    def net_movements(self):
+        return self._per_phrase_sum(self.increments.astype(np.int64))
+
+    def scale_types(self):
+        return np.where(self.net_movements() >= 0, "arohana", "avarohana")
+
+    def where(self, mask):
+        # Indices of the phrases a boolean mask (e.g. lengths() > 3) selects
+        return np.flatnonzero(np.asarray(mask, dtype=bool))
+
+    def subset(self, indices):
+        # A new library of the given phrases, gathered without any Note objects
+        indices = np.asarray(indices, dtype=np.int64)
+        lengths = self.lengths()[indices]
+        starts = self.offsets[:-1][indices]
+        before = np.cumsum(lengths) - lengths
+        gather = np.repeat(starts - before, lengths) + np.arange(lengths.sum())
+        library = PhraseLibrary()
+        library.meendhs = list(self.meendhs)
+        library._codes = dict(self._codes)
+        library.extend_arrays(
+            self.increments[gather],
+            self.durations[gather],
+            self.meendh_codes[gather],
+            lengths,
+        )
+        return library
 
 
 class Raga:
@@ -87,59 +375,324 @@ class Raga:
         rules=None,
         meendhMap=[],
         step_frequencies={},
+        output=None,
+        late_policy="catchup",
+        wobble=None,
+        meendh_bends=None,
+        glide=None,
+        ppq=PPQ,
+        cache=None,
+        channel=0,
+        dedupe=True,
     ):
         self.name = name
         self.arohana = arohana
         self.avarohana = avarohana
-        self.phrases = []
+        self.phrases = PhraseLibrary()
         self.tal = tal
         self.bpm = bpm
+        self.ppq = ppq  # ticks per beat for all internal timing
         self.rules = rules if rules is not None else {}
         self.meendhMap = meendhMap
         self.step_frequencies = step_frequencies
+        self.output = output  # None means the shared default output
+        self.late_policy = late_policy  # what playmidi does with late events
+        self.rng = random.Random()  # replaced by seed() for reproducible output
+        self.last_jitter = None
+        # add_wobble settings: depth, rate, shape and control_rate as taken by
+        # gamak.wobble_messages, e.g. {"depth": 300, "shape": "sine"}
+        self.wobble = dict(wobble) if wobble else {}
+        # meendhs played as pitch bend glides instead of keyswitches, as the
+        # number of scale steps to bend, e.g. {"up": 1, "down": -1}
+        self.meendh_bends = dict(meendh_bends) if meendh_bends else {}
+        # glide ramp settings, e.g. {"steps": 32, "shape": "ease", "hold": 0.25}
+        self.glide = dict(glide) if glide else {}
+        self.cache = cache  # optional RenderCache for rendered phrases
+        self.channel = channel  # MIDI channel composed messages go out on
+        self.dedupe = dedupe  # add_phrase skips phrases already in the library
+        self._fingerprint = None
+        self._bend_table = None
+        self._templates = {}  # (id(phrase), start step) -> (phrase, template)
+        self._library_cache = {}  # indexes over self.phrases
+        self._phrase_index = None
+        self.phrases_selected = 0  # phrases chosen by selection rules so far
+        self.recent_phrases = ()  # the last few of them, oldest first
+
+    @property
+    def outport(self):
+        # resolved lazily so nothing opens a MIDI port until playback needs one
+        return self.output if self.output is not None else get_output()
+
+    @property
+    def engine(self):
+        return get_engine(self.outport, late_policy=self.late_policy)
 
     def __setitem__(self, key, value):
         self.rules[key] = value
 
-    def add_phrase(self, phrase):
-        self.phrases.append(phrase)
+    def __setstate__(self, state):
+        # Compiled templates are keyed by id(phrase), which unpickling changes
+        self.__dict__.update(state)
+        self._templates = {
+            (id(phrase), start): (phrase, template)
+            for (_, start), (phrase, template) in self._templates.items()
+        }
+
+    def voice(self, channel=None, rules=None):
+        # A copy for one player: its own rules overlay, random stream and
+        # channel, sharing the phrase library and compiled caches
+        voice = copy.copy(self)
+        voice.rules = dict(self.rules)
+        if rules:
+            voice.rules.update(rules)
+        if channel is not None:
+            voice.channel = channel
+        voice.rng = random.Random()
+        return voice
+
+    @property
+    def phrase_index(self):
+        # Exact and similarity lookups over self.phrases, kept up to date
+        index = self._phrase_index
+        if index is None or index.library is not self.phrases:
+            index = self._phrase_index = PhraseIndex(self.phrases)
+        return index
+
+    def add_phrase(self, phrase, min_distance=None):
+        # Returns the stored phrase. With dedupe on, a phrase already in the
+        # library (or, given min_distance, one that close to it) is returned
+        # instead of being added again.
+        if self.dedupe:
+            index = self.phrase_index
+            existing = index.find(phrase)
+            if existing is None and min_distance is not None:
+                nearest = index.nearest(phrase, 1)
+                if nearest and nearest[0][1] <= min_distance:
+                    existing = nearest[0][0]
+            if existing is not None:
+                return self.phrases[existing]
+        stored = self.phrases.append(phrase)
+        self._library_cache.clear()
+        return stored
+
+    def add_phrases(self, phrases):
+        # Many at once, e.g. a PhraseLibrary from variation.mutate_phrases
+        if self.dedupe:
+            if not isinstance(phrases, PhraseLibrary):
+                phrases = PhraseLibrary(phrases)
+            phrases = phrases.subset(self.phrase_index.new_phrases(phrases))
+        self.phrases.extend(phrases)
+        self._library_cache.clear()
+
+    def similar_phrases(self, phrase, k=5):
+        # [(phrase, distance), ...] from the library, most similar first
+        return [
+            (self.phrases[i], distance)
+            for i, distance in self.phrase_index.nearest(phrase, k)
+        ]
+
+    def library_cache(self, key, build):
+        # Values derived from the phrase library, rebuilt after add_phrase
+        value = self._library_cache.get(key)
+        if value is None:
+            value = self._library_cache[key] = build()
+        return value
+
+    def template(self, phrase, start_scale_step=0):
+        # Compiled pitch skeleton of a phrase, built once per start step
+        key = (id(phrase), start_scale_step)
+        cached = self._templates.get(key)
+        if cached is None or cached[0] is not phrase:
+            cached = (phrase, compile_phrase(phrase, self, start_scale_step))
+            self._templates[key] = cached
+        return cached[1]
+
+    @property
+    def fingerprint(self):
+        # Stable digest of the settings a rendered phrase depends on, besides
+        # the phrase itself. Selection reads more (tal, say), so whole
+        # performances are keyed on those too; see batch.performance_key.
+        if self._fingerprint is None:
+            self._fingerprint = stable_hash(
+                (
+                    self.name,
+                    list(self.arohana),
+                    list(self.avarohana),
+                    sorted(dict(self.meendhMap).items()),
+                    sorted(self.step_frequencies.items()),
+                    sorted(self.wobble.items()),
+                    sorted(self.meendh_bends.items()),
+                    sorted(self.glide.items()),
+                    self.bpm,
+                    self.ppq,
+                )
+            )
+        return self._fingerprint
+
+    @property
+    def library_fingerprint(self):
+        return self.library_cache(
+            ("fingerprint",),
+            lambda: stable_hash([phrase.key() for phrase in self.phrases]),
+        )
 
-    def play(self, start_scale_step=None):
-        if not self.phrases:
-            raise ValueError("No phrases added to the Raga")
+    @property
+    def bend_table(self):
+        if self._bend_table is None:
+            self._bend_table = BendTable(self.step_frequencies)
+        return self._bend_table
 
-        played_sequences = []
+    def clear_caches(self):
+        # Call after changing the scales, meendhMap or step_frequencies
+        self._templates.clear()
+        self._library_cache.clear()
+        self._fingerprint = None
+        self._bend_table = None
 
-        # Apply raga-specific rules
-        base_velocity, base_duration, phrase_velocity, sequence = self.get_rules()
+    def seed(self, seed, *names):
+        # Derive this raga's stream from a session seed; names tell apart
+        # several copies of one raga (one per player, say)
+        self.rng = make_rng(seed, "raga", self.name, *names)
 
-        start_scale_step = self.set_scale_step(start_scale_step)
+    def seconds_to_ticks(self, seconds):
+        return seconds_to_ticks(seconds, self.bpm, self.ppq)
 
-        # Generate MIDI sequence
-        midi_sequence, playing_time = self.get_midi_sequence(
-            start_scale_step, base_duration, phrase_velocity, sequence
-        )
+    def ticks_to_seconds(self, ticks):
+        return ticks_to_seconds(ticks, self.bpm, self.ppq)
 
-        # Apply velocity rule to each note in the sequence
-        midi_sequence = self.getvelocities(
-            base_velocity, phrase_velocity, midi_sequence
-        )
+    def play(self, start_scale_step=None):
+        # Returns the playing time in seconds
+        return self.ticks_to_seconds(self.play_ticks(start_scale_step))
+
+    def play_ticks(self, start_scale_step=None):
+        # The phrase is due now; time spent composing it is caught up on playback
+        start = time.perf_counter()
+        midi_sequence, playing_ticks = self.compose(start_scale_step)
 
-        # Play the sequences
-        thread_notes = threading.Thread(target=self.playmidi, args=(midi_sequence,))
-        thread_notes.start()
+        # Hand the sequence to the port's playback engine, which merges it
+        # with every other player's events in time order
+        self.engine.submit(sequence_events(midi_sequence), start)
 
         # if random.random()>0.5:
         # wobble=threading.Thread(target=add_wobble, args = (0, 0.5,  self.step_frequencies))
         # wobble.start()
 
-        # return the length in bars or beats
+        # return the length in ticks
 
-        return playing_time
+        return playing_ticks
+
+    def compose(self, start_scale_step=None):
+        # Build the next stretch of music without playing it. Returns the
+        # messages and their length in ticks.
+        if not self.phrases:
+            raise ValueError("No phrases added to the Raga")
+
+        metrics = get_metrics()
+        with metrics.timer("generation_seconds"):
+            # Apply raga-specific rules
+            with metrics.timer("rules_seconds"):
+                rules = self.get_rules()
+            base_velocity, base_duration, phrase_velocity, sequence = rules
+
+            start_scale_step = self.set_scale_step(start_scale_step)
+
+            # Generate MIDI sequence
+            with metrics.timer("build_seconds"):
+                midi_sequence, playing_ticks = self.get_midi_sequence(
+                    start_scale_step, base_duration, phrase_velocity, sequence
+                )
+
+            # Apply velocity rule to each note in the sequence
+            with metrics.timer("velocity_seconds"):
+                midi_sequence = self.getvelocities(
+                    base_velocity, phrase_velocity, midi_sequence
+                )
+
+            if self.channel:
+                for msg in midi_sequence:
+                    msg.channel = self.channel
+
+        metrics.inc("phrases_composed_total", len(sequence))
+        return midi_sequence, playing_ticks
+
+    def stream(self, start_scale_step=None):
+        """
+        Endless (offset in seconds, message) events, composed a phrase at a
+        time as they are consumed. Velocities are shaped over each phrase
+        rather than over the whole selection, so nothing larger than one
+        phrase is ever held and the first note is ready after one phrase.
+        """
+        metrics = get_metrics()
+        # each phrase starts at a whole tick, so phrases never drift apart
+        ticks = 0
+        while True:
+            base_velocity, base_duration, phrase_velocity, sequence = self.get_rules()
+            step = self.set_scale_step(start_scale_step)
+            for phrase in sequence:
+                midi_sequence, phrase_ticks = phrase.get_midi_sequence(
+                    self, step, base_duration, phrase_velocity
+                )
+                midi_sequence = self.getvelocities(
+                    base_velocity, phrase_velocity, midi_sequence
+                )
+                if self.channel:
+                    for msg in midi_sequence:
+                        msg.channel = self.channel
+                metrics.inc("phrases_composed_total")
+
+                origin = self.ticks_to_seconds(ticks)
+                ticks += phrase_ticks
+                # offsets inside the phrase are float sums of message times,
+                # which can land a hair past its end and after the next
+                # phrase's first note; hold them to the end
+                end = self.ticks_to_seconds(ticks)
+                for offset, msg in sequence_events(midi_sequence):
+                    yield min(origin + offset, end), msg
+
+    def perform_stream(self, events=None, duration=None, lookahead=0.5, stop=None):
+        # Plays stream() (or any event iterator) through the playback engine,
+        # keeping at most `lookahead` seconds queued ahead of the clock. Runs
+        # for `duration` seconds, until stop (a threading.Event) is set, or
+        # forever.
+        events = self.stream() if events is None else events
+        engine = self.engine
+        sounding = set()
+        start = time.perf_counter()
+        end = 0.0
+        try:
+            for offset, msg in events:
+                if duration is not None and offset >= duration:
+                    break
+                if stop is not None and stop.is_set():
+                    break
+                wait = start + offset - lookahead - time.perf_counter()
+                if wait > 0:
+                    if stop is not None:
+                        stop.wait(wait)
+                    else:
+                        time.sleep(wait)
+                if msg.type == "note_on" and msg.velocity:
+                    sounding.add((msg.channel, msg.note))
+                elif msg.type in ("note_on", "note_off"):
+                    sounding.discard((msg.channel, msg.note))
+                engine.submit([(offset, msg)], start)
+                end = offset
+        finally:
+            # notes whose note_off was never reached are released at the end
+            engine.submit(
+                [
+                    (end, mido.Message("note_off", channel=channel, note=note))
+                    for channel, note in sorted(sounding)
+                ],
+                start,
+            )
+        return end
 
     def set_scale_step(self, start_scale_step):
         start_scale_step = (
-            start_scale_step if start_scale_step is not None else random.choice([0, 7])
+            start_scale_step
+            if start_scale_step is not None
+            else self.rng.choice([0, 7])
         )
 
         return start_scale_step
@@ -148,102 +701,136 @@ class Raga:
         base_velocity = self.rules.get("base_velocity_rule", lambda x: 64)
         phrases = self.phrases
 
-        params = {"raga": self}
+        # rules draw any randomness from params["rng"]
+        params = {"raga": self, "rng": self.rng}
         base_duration = self.rules.get("base_duration_rule", lambda x: 0.5)(params)
         phrase_velocity = self.rules.get("phrase_velocity_rule", lambda x: 64)(params)
 
-        params = {"raga": self, "base_duration": base_duration}
-        sequence = self.rules.get(
-            "phrase_selection_rule", lambda x: random.choice(phrases)
-        )(params)
+        params = {
+            "raga": self,
+            "base_duration": base_duration,
+            "rng": self.rng,
+            "phrase_index": self.phrases_selected,
+            "total_phrases": len(phrases),
+            "previous_phrases": self.recent_phrases,
+        }
+        with get_metrics().timer("selection_seconds"):
+            sequence = self.rules.get(
+                "phrase_selection_rule", lambda x: [x["rng"].choice(phrases)]
+            )(params)
+        self.phrases_selected += len(sequence)
+        self.recent_phrases = (self.recent_phrases + tuple(sequence))[-RECENT_PHRASES:]
         return base_velocity, base_duration, phrase_velocity, sequence
 
     def get_midi_sequence(
         self, start_scale_step, base_duration, phrase_velocity, sequence
     ):
         midi_sequence = []
-        playing_time = 0
+        playing_ticks = 0
         for phrase in sequence:
-            midi_sub_sequence, this_playing_time = phrase.get_midi_sequence(
+            midi_sub_sequence, phrase_ticks = phrase.get_midi_sequence(
                 self, start_scale_step, base_duration, phrase_velocity
             )
             midi_sequence += midi_sub_sequence
-            playing_time += this_playing_time
-        return midi_sequence, playing_time
+            playing_ticks += phrase_ticks
+        return midi_sequence, playing_ticks
 
     def getvelocities(self, base_velocity, phrase_velocity, midi_sequence):
-        for i, msg in enumerate(midi_sequence):
-            if msg.type == "note_on":
-                params = {
-                    "note_index": i,
-                    "total_notes": len(midi_sequence),
-                    "raga": self,
-                }
-                msg.velocity = base_velocity(params)
-                msg.velocity = int((msg.velocity + phrase_velocity) / 2)
+        # Keyswitch note_ons select articulations; their velocity is left alone
+        indices = [
+            i
+            for i, msg in enumerate(midi_sequence)
+            if msg.type == "note_on" and not isinstance(msg, KeyswitchMessage)
+        ]
+        params = {
+            "total_notes": len(midi_sequence),
+            "raga": self,
+            "rng": self.rng,
+        }
+
+        if getattr(base_velocity, "vectorized", False):
+            # one call for the whole sequence with an array of note indices
+            params["note_index"] = np.asarray(indices, dtype=np.int64)
+            velocities = np.asarray(base_velocity(params))
+            velocities = ((velocities + phrase_velocity) / 2).astype(int).tolist()
+        else:
+            velocities = []
+            for i in indices:
+                params["note_index"] = i
+                velocities.append(int((base_velocity(params) + phrase_velocity) / 2))
+
+        for i, velocity in zip(indices, velocities):
+            midi_sequence[i].velocity = velocity
         return midi_sequence
 
-    def playmidi(self, midi_sequence):
-        outport = OUTPORT
+    def add_wobble(self, target_step, actual_duration):
+        # Only called for notes that actually wobble
+        return wobble_messages(
+            self.bend_table, target_step, actual_duration, **self.wobble
+        )
 
-        for msg in midi_sequence:
-            if msg.type == "note_off":
-                # For real-time playing, time attribute is not used in 'note_off'
-                outport.send(msg)
-            else:
-                outport.send(msg)
-                # Delay for the duration of the note
-                time.sleep(msg.time)
+    def add_glide(self, step, step_delta, actual_duration):
+        # Meendh as a bend from the sounding note towards step + step_delta
+        return glide_messages(
+            self.bend_table, step, step_delta, actual_duration, **self.glide
+        )
+
+    def playmidi(self, midi_sequence, start=None):
+        # Every message is sent against an absolute deadline from one start time
+        scheduler = DeadlineScheduler(self.outport, late_policy=self.late_policy)
+        self.last_jitter = scheduler.play(sequence_events(midi_sequence), start)
+        return self.last_jitter
 
     def mmcmidi(self):
         mmc_play = mido.Message("sysex", data=[0x7F, 0x7F, 0x06, 0x02])
 
         # To send it, open a port and send the message
-        print("sending mmc play")
-        outport = OUTPORT
+        log.info("sending mmc play")
+        outport = self.outport
         outport.send(mmc_play)
 
 
-# PITCH BENDING____________________________________________________
-import math
+def sequence_events(midi_sequence):
+    # Turn a played sequence into (offset in seconds, message) pairs.
+    # playmidi waits msg.time after every message except note_off, so that is
+    # the delay before the next message goes out.
+    events = []
+    offset = 0
+    for msg in midi_sequence:
+        events.append((offset, msg))
+        if msg.type != "note_off":
+            offset += msg.time
+    return events
 
-# need to change all of this to create a midi sequence rather than actually output the midi.
+
+# PITCH BENDING____________________________________________________
 
 
 def send_pitch_bend_ramp(
-    current_step, step_delta, duration, step_frequencies, max_bend=8191, outport=OUTPORT
+    current_step,
+    step_delta,
+    duration,
+    step_frequencies,
+    max_bend=8191,
+    outport=None,
+    ramp_steps=10,
+    shape="linear",
 ):
-    # Calculate the current and target frequency ratios
-    current_ratio = step_frequencies.get(current_step)
-    target_ratio = step_frequencies.get(current_step + step_delta)
-
-    if current_ratio is None or target_ratio is None:
-        raise ValueError("Invalid scale step")
-
-    # Convert ratios to semitones
-    current_semitones = 12 * math.log2(current_ratio)
-    target_semitones = 12 * math.log2(target_ratio)
-
-    # Calculate the current and target pitch bend values
-    current_bend = calculate_pitch_bend_for_semitones(current_semitones, max_bend)
-    target_bend = calculate_pitch_bend_for_semitones(target_semitones, max_bend)
-
-    # Wait for half the duration before starting the pitch bend
-    time.sleep(duration / 2)
-
-    # Number of steps for the ramp
-    ramp_steps = 10  # Adjust for smoother transitions
-
-    # Linearly interpolate between current and target pitch bend
-    for i in range(ramp_steps + 1):
-        fraction = i / ramp_steps
-        bend_value = int(current_bend + (target_bend - current_bend) * fraction)
-        bend_message = mido.Message("pitchwheel", pitch=bend_value)
-        outport.send(bend_message)
-        time.sleep(duration / 2 / ramp_steps)
-
-    # reset
-    # bend_message = mido.Message('pitchwheel', pitch=0)
+    # Returns the ramp as pitchwheel messages for a midi sequence. Passing an
+    # outport schedules them on that port's playback engine instead.
+    table = bend_table(step_frequencies, max_bend)
+    messages = glide_messages(
+        table,
+        current_step,
+        step_delta,
+        duration,
+        steps=ramp_steps,
+        shape=shape,
+        start_bend=table.bend(current_step),
+    )
+    if outport is not None:
+        get_engine(outport).submit(sequence_events(messages))
+    return messages
 
 
 def add_wobble(
@@ -253,48 +840,27 @@ def add_wobble(
     max_bend=8191,
     wobble_intensity=500,
     wobble_rate=6,
-    outport=OUTPORT,
+    outport=None,
+    shape="square",
+    control_rate=100,
 ):
-    target_ratio = step_frequencies.get(target_step)
-    target_semitones = 12 * math.log2(target_ratio)
-    target_bend = calculate_pitch_bend_for_semitones(target_semitones, max_bend)
-
-    wobble_step = wobble_intensity  # Adjust for desired wobble intensity
-    wobble_frequency = wobble_rate  # Adjust for desired wobble rate
-    num_of_wobbles = int(actual_duration * wobble_frequency)
-
-    seq = []
-    for i in range(num_of_wobbles):
-        # Alternate pitch bend for wobble
-        seq.append(
-            mido.Message(
-                "pitchwheel",
-                pitch=target_bend + wobble_step,
-                time=(1 / (2 * wobble_frequency)),
-            )
-        )
-        seq.append(
-            mido.Message(
-                "pitchwheel",
-                pitch=target_bend - wobble_step,
-                time=(1 / (2 * wobble_frequency)),
-            )
-        )
-        seq.append(mido.Message("pitchwheel", pitch=0))
-
-    return seq
+    # Alternate (or sweep) the pitch bend around the target step
+    return wobble_messages(
+        bend_table(step_frequencies, max_bend),
+        target_step,
+        actual_duration,
+        depth=wobble_intensity,
+        rate=wobble_rate,
+        shape=shape,
+        control_rate=control_rate,
+    )
 
 
 def calculate_pitch_bend_for_step(step, step_frequencies, max_bend=8191):
-    frequency_ratio = step_frequencies.get(step)
-    if frequency_ratio is None:
+    table = bend_table(step_frequencies, max_bend)
+    if step not in table:
         raise ValueError("Step not defined in Raga Bhairav")
-
-    # Calculate the number of semitones the step represents
-    semitones = 12 * math.log2(frequency_ratio)
-
-    # Calculate and return the pitch bend value
-    return calculate_pitch_bend_for_semitones(semitones, max_bend)
+    return table.bend(step)
 
 
 def calculate_pitch_bend_for_semitones(semitones, max_bend=8191, octave=12):
@@ -0,0 +1,229 @@
+# Phrase-transition model for selection. Next-phrase distributions are
+# compiled into alias samplers, so each pick is O(1) however large the
+# library, and successive picks follow on from each other musically.
+from collections import Counter, defaultdict
+
+import numpy as np
+
+from cache import stable_hash
+from selection import AliasSampler
+
+
+def phrase_indices(key):
+    # A history or target key as a tuple of phrase indices. Raga files only
+    # have text keys, so "3" and "3,5" are read as (3,) and (3, 5).
+    if isinstance(key, str):
+        try:
+            key = tuple(int(part) for part in key.split(","))
+        except ValueError:
+            raise ValueError(f"{key!r} is not a phrase index") from None
+    elif not isinstance(key, tuple):
+        key = (key,)
+    for index in key:
+        if not isinstance(index, (int, np.integer)) or index < 0:
+            raise ValueError(f"{index!r} is not a phrase index")
+    return tuple(int(index) for index in key)
+
+
+def _target(key):
+    indices = phrase_indices(key)
+    if len(indices) != 1:
+        raise ValueError(f"{key!r} is not a phrase index")
+    return indices[0]
+
+
+class PhraseTransitions:
+    """
+    Next-phrase distributions over a PhraseLibrary, by library index.
+
+    A pick uses the most specific context available:
+    - `table`: given or learned weights after the last 1..`order` phrases
+      (an n-gram), keyed by tuples of indices;
+    - the previous phrase's ending pitch and scale direction, weighted by a
+      contour prior: small leaps into the next phrase are preferred
+      (`leap_penalty` per scale step), changes of direction are
+      `turn_weight` times as likely, and repeating the previous phrase is
+      kept with probability `repeat_weight`;
+    - `initial` weights (uniform by default) when nothing has been played.
+
+    Context samplers are built the first time a context is met; compile()
+    builds them all up front.
+    """
+
+    def __init__(
+        self,
+        library,
+        table=None,
+        initial=None,
+        order=1,
+        leap_penalty=0.5,
+        turn_weight=2.0,
+        repeat_weight=0.25,
+    ):
+        if not len(library):
+            raise ValueError("No phrases to select from")
+        self.library = library
+        self.order = order
+        self.leap_penalty = leap_penalty
+        self.turn_weight = turn_weight
+        self.repeat_weight = repeat_weight
+
+        lengths = library.lengths()
+        starts = np.minimum(library.offsets[:-1], max(len(library.increments) - 1, 0))
+        self.nets = library.net_movements()  # where each phrase ends up
+        self.firsts = np.where(lengths > 0, library.increments[starts], 0)
+        self.ascending = self.nets >= 0  # Phrase.get_scale_type() == "arohana"
+
+        self._table = {}  # history tuple -> (next indices, AliasSampler)
+        for history, weights in (table or {}).items():
+            history = history if isinstance(history, tuple) else (history,)
+            targets = list(weights)
+            self._table[history] = (
+                targets,
+                AliasSampler([weights[target] for target in targets]),
+            )
+        if initial:
+            targets = list(initial)
+            self._initial = (
+                targets,
+                AliasSampler([initial[target] for target in targets]),
+            )
+        else:
+            self._initial = None
+        self._contexts = {}  # (ending pitch, ascending) -> AliasSampler
+
+    def __len__(self):
+        return len(self.nets)
+
+    @classmethod
+    def learn(cls, library, sequences, order=1, **kwargs):
+        # Transition counts from example performances, each a list of library
+        # indices (or phrases from the library)
+        counts = defaultdict(Counter)
+        initial = Counter()
+        for sequence in sequences:
+            indices = [
+                i if isinstance(i, (int, np.integer)) else library.index(i)
+                for i in sequence
+            ]
+            if indices:
+                initial[indices[0]] += 1
+            for t in range(1, len(indices)):
+                for k in range(1, min(order, t) + 1):
+                    counts[tuple(indices[t - k : t])][indices[t]] += 1
+        return cls(
+            library,
+            table={history: dict(c) for history, c in counts.items()},
+            initial=dict(initial),
+            order=order,
+            **kwargs,
+        )
+
+    def context(self, previous):
+        return int(self.nets[previous]), bool(self.ascending[previous])
+
+    def _context_sampler(self, context):
+        sampler = self._contexts.get(context)
+        if sampler is None:
+            ending, ascending = context
+            weights = np.exp(-self.leap_penalty * np.abs(self.firsts - ending))
+            weights[self.ascending != ascending] *= self.turn_weight
+            sampler = self._contexts[context] = AliasSampler(weights.tolist())
+        return sampler
+
+    def compile(self):
+        _, firsts = np.unique(self.nets, return_index=True)
+        for previous in firsts.tolist():
+            self._context_sampler(self.context(previous))
+        return self
+
+    def sample(self, rng, history=()):
+        # The next phrase's index after the phrases (indices) in history
+        history = tuple(history)[-self.order :] if self.order else ()
+        for k in range(len(history), 0, -1):
+            entry = self._table.get(history[-k:])
+            if entry is not None:
+                targets, sampler = entry
+                return targets[sampler.sample(rng)]
+
+        if not history:
+            if self._initial is None:
+                return int(rng.random() * len(self))
+            targets, sampler = self._initial
+            return targets[sampler.sample(rng)]
+
+        previous = history[-1]
+        sampler = self._context_sampler(self.context(previous))
+        choice = sampler.sample(rng)
+        if choice == previous and rng.random() >= self.repeat_weight:
+            choice = sampler.sample(rng)  # one redraw keeps picks O(1)
+        return choice
+
+    def sequence(self, rng, count, history=()):
+        # `count` indices, each following on from the ones before
+        history = list(history)
+        chosen = []
+        for _ in range(count):
+            choice = self.sample(rng, history)
+            chosen.append(choice)
+            history.append(choice)
+        return chosen
+
+
+class MarkovSelectionRule:
+    """
+    phrase_selection_rule picking `count` phrases in a row from a
+    PhraseTransitions model of the raga's library, carrying on from the
+    phrases the raga played last.
+
+    `transitions` is a prebuilt model, e.g. from PhraseTransitions.learn(),
+    over the raga's library. Without one, the model is built from the other
+    keyword arguments (table, initial, order, leap_penalty, ...) and cached
+    on the raga.
+    """
+
+    def __init__(self, count=3, transitions=None, **model):
+        self.count = count
+        self.transitions = transitions
+        if model.get("table"):
+            model["table"] = {
+                phrase_indices(history): {
+                    _target(target): weight for target, weight in weights.items()
+                }
+                for history, weights in model["table"].items()
+            }
+        if model.get("initial"):
+            model["initial"] = {
+                _target(target): weight for target, weight in model["initial"].items()
+            }
+        self.model = model
+        # tables can be large, so their hash is taken once here, not per pick
+        self.key = ("markov", stable_hash(model))
+
+    def indices(self):
+        # every phrase index the given table and initial weights name
+        table = self.model.get("table") or {}
+        named = set(self.model.get("initial") or ())
+        for history, weights in table.items():
+            named.update(history)
+            named.update(weights)
+        return named
+
+    def __call__(self, params):
+        raga = params["raga"]
+        library = raga.phrases
+        transitions = self.transitions
+        if transitions is None:
+            transitions = raga.library_cache(
+                self.key, lambda: PhraseTransitions(library, **self.model)
+            )
+        elif transitions.library is not library:
+            raise ValueError("transitions were built for another phrase library")
+        history = []
+        for phrase in params.get("previous_phrases", ()):
+            try:
+                history.append(library.index(phrase))
+            except ValueError:
+                pass  # no longer in the library
+        chosen = transitions.sequence(params["rng"], self.count, history)
+        return [library[i] for i in chosen]
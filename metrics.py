@@ -0,0 +1,211 @@
+# Opt-in instrumentation. Hot paths record through get_metrics(), which is a
+# do-nothing registry until enable() is called, so uninstrumented runs only pay
+# for a method call. Enabled metrics can be polled with snapshot() or served
+# as Prometheus text from a local HTTP endpoint.
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# seconds; generation and send lateness both live in this range
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        cumulative = []
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return {"buckets": cumulative, "sum": self.sum, "count": self.count}
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Metrics:
+    """Counters, gauges and latency histograms, safe to update from any thread."""
+
+    enabled = True
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        # value may be a callable, read whenever the metrics are collected
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def timer(self, name):
+        # with metrics.timer("compose_seconds"): ...
+        return _Timer(self, name)
+
+    def snapshot(self):
+        with self._lock:
+            gauges = dict(self.gauges)
+            return {
+                "counters": dict(self.counters),
+                "gauges": {
+                    name: value() if callable(value) else value
+                    for name, value in gauges.items()
+                },
+                "histograms": {
+                    name: histogram.snapshot()
+                    for name, histogram in self.histograms.items()
+                },
+            }
+
+    def prometheus(self, prefix="raga_"):
+        # The Prometheus text exposition format
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot["counters"].items()):
+            lines += [f"# TYPE {prefix}{name} counter", f"{prefix}{name} {value}"]
+        for name, value in sorted(snapshot["gauges"].items()):
+            lines += [f"# TYPE {prefix}{name} gauge", f"{prefix}{name} {value}"]
+        for name, histogram in sorted(snapshot["histograms"].items()):
+            lines.append(f"# TYPE {prefix}{name} histogram")
+            for bound, count in histogram["buckets"]:
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{prefix}{name}_bucket{{le="{le}"}} {count}')
+            lines.append(f"{prefix}{name}_sum {histogram['sum']}")
+            lines.append(f"{prefix}{name}_count {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port=9100, host="127.0.0.1"):
+        # GET /metrics from a background thread; returns the bound port
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") not in ("", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(
+            target=self._server.serve_forever, name="metrics", daemon=True
+        ).start()
+        return self._server.server_address[1]
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+class NullMetrics:
+    """Stands in while instrumentation is off; every call does nothing."""
+
+    enabled = False
+    _timer = nullcontext()
+
+    def inc(self, name, value=1):
+        pass
+
+    def set(self, name, value):
+        pass
+
+    def observe(self, name, value):
+        pass
+
+    def timer(self, name):
+        return self._timer
+
+    def snapshot(self):
+        return {"counters": {}, "gauges": {}, "histograms": {}}
+
+
+_metrics = NullMetrics()
+
+
+def get_metrics():
+    return _metrics
+
+
+def enable(metrics=None):
+    global _metrics
+    _metrics = metrics if metrics is not None else Metrics()
+    return _metrics
+
+
+def disable():
+    global _metrics
+    _metrics = NullMetrics()
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets each log call site through at most once per `interval` seconds.
+    Records that get through carry how many were held back as `suppressed`.
+    """
+
+    def __init__(self, interval=1.0, clock=time.monotonic):
+        super().__init__()
+        self.interval = interval
+        self.clock = clock
+        self._last = {}  # (logger, message template) -> (time, suppressed)
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = self.clock()
+        last, suppressed = self._last.get(key, (None, 0))
+        if last is not None and now - last < self.interval:
+            self._last[key] = (last, suppressed + 1)
+            return False
+        self._last[key] = (now, 0)
+        record.suppressed = suppressed
+        return True
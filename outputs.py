@@ -0,0 +1,72 @@
+import mido
+
+DEFAULT_PORT = "loopMIDI Port 4"
+
+
+class OutputBackend:
+    """Somewhere to send MIDI messages. Subclasses override send()."""
+
+    def send(self, msg):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class RtMidiBackend(OutputBackend):
+    """Real-time output through mido's rtmidi port. The port opens on first send."""
+
+    def __init__(self, port_name=DEFAULT_PORT):
+        self.port_name = port_name
+        self._port = None
+
+    @property
+    def port(self):
+        if self._port is None:
+            self._port = mido.open_output(self.port_name)
+        return self._port
+
+    def send(self, msg):
+        self.port.send(msg)
+
+    def close(self):
+        if self._port is not None:
+            self._port.close()
+            self._port = None
+
+
+class CaptureBackend(OutputBackend):
+    """Keeps every message sent to it, for tests, benchmarks and inspection."""
+
+    def __init__(self):
+        self.messages = []
+
+    def send(self, msg):
+        self.messages.append(msg)
+
+    def clear(self):
+        self.messages = []
+
+
+class NullBackend(OutputBackend):
+    """Discards everything."""
+
+    def send(self, msg):
+        pass
+
+
+_default_output = None
+
+
+def get_output():
+    # the default output is only created (and its port only opened) when first needed
+    global _default_output
+    if _default_output is None:
+        _default_output = RtMidiBackend()
+    return _default_output
+
+
+def set_output(output):
+    global _default_output
+    _default_output = output
+    return output
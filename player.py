@@ -1,7 +1,23 @@
 # Play the Raga Bhairav
-from bhairav import raga_bhairav as raga
+from bhairav import raga_bhairav
+import logging
 import simpy
-import random
+import time
+
+import metrics
+from lookahead import PhraseBuffer
+from main import sequence_events
+from timing import PPQ, beats_to_ticks
+
+log = logging.getLogger("raga.player")
+# the per-beat clock line is only logged every few seconds, so logging stays
+# off the real-time thread's critical path
+beat_log = logging.getLogger("raga.timer")
+beat_log.addFilter(metrics.RateLimitFilter(interval=5.0))
+lag_log = logging.getLogger("raga.timer.lag")
+lag_log.addFilter(metrics.RateLimitFilter(interval=1.0))
+
+METRICS_PORT = None  # e.g. 9100 to serve /metrics while playing
 
 
 class scheduledevent:
@@ -12,13 +28,18 @@ class scheduledevent:
 
 
 class conductor:
-    def __init__(self, env, schedule):
+    # The clock counts ticks (ppq per beat); schedule times are in beats
+    def __init__(self, env, schedule, raga=None, ppq=PPQ):
         self.env = env
+        self.raga = raga  # sent MMC play on start when given
+        self.ppq = ppq
         self.players = []
+        self._pending = []  # (player, event) waiting for this tick's batch
         self.implementschedule(schedule)
         self.timer = env.process(self.timer())
 
     def implementschedule(self, schedule):
+        env = self.env
         for item in schedule:
             event = env.event()
             event.name = item.name
@@ -27,107 +48,233 @@ class conductor:
             env.process(self.scheduleevent(event))
 
     def scheduleevent(self, event):
-        yield env.timeout(event.time)
-        print("Event triggered", event.name)
+        yield self.env.timeout(beats_to_ticks(event.time, self.ppq))
+        log.info("event name=%s", event.name)
+        metrics.get_metrics().inc("events_triggered_total")
         self.notify(event)
 
     def addplayer(self, player):
         self.players.append(player)
+        player.conductor = self
+
+    def request(self, player):
+        # Players ask for their next phrase here; every request made on the
+        # same tick is composed and sent together
+        event = self.env.event()
+        if not self._pending:
+            self.env.process(self.perform_pending())
+        self._pending.append((player, event))
+        return event
+
+    def perform_pending(self):
+        # runs after every player due on this tick has made its request
+        yield self.env.timeout(0)
+        pending, self._pending = self._pending, []
+
+        start = time.perf_counter()
+        batches = {}
+        for player, event in pending:
+            midi_sequence, playing_ticks = player.compose()
+            player.submit(midi_sequence, start, batches)
+            event.succeed(playing_ticks)
+        for engine, batch in batches.items():
+            engine.submit_many(batch)
 
     def notify(self, event):
-        print("notifying", event.mood)
+        log.info("notify mood=%s", event.mood)
         for player in self.players:
             if event.name in player.participation:
                 player.mood = event.mood
             else:
                 player.mood = None  # no mood to play
+            if player.buffer is not None:
+                # apply now, so phrases composed ahead for the old mood are dropped
+                player.checkmood()
 
     def begin(self):
-        yield env.timeout(0)
-        raga.mmcmidi()
+        yield self.env.timeout(0)
+        if self.raga is not None:
+            self.raga.mmcmidi()
         for player in self.players:
             self.env.process(player.play_raga())
 
     def timer(self):
         env = self.env
         while 1:
-            print("Time", env.now)
-            yield env.timeout(1)
+            beat = env.now // self.ppq
+            metrics.get_metrics().set("beat", beat)
+            beat_log.info("time beat=%d", beat)
+            self.checklag()
+            yield env.timeout(self.ppq)
+
+    def checklag(self):
+        # A real-time clock runs non-strict, since its units are ticks and
+        # strict mode would allow only one tick of lag; falling more than a
+        # beat behind is reported here instead
+        env = self.env
+        if not isinstance(env, simpy.rt.RealtimeEnvironment):
+            return
+        due = env.real_start + (env.now - env.env_start) * env.factor
+        lag = time.monotonic() - due
+        metrics.get_metrics().set("realtime_lag_seconds", max(lag, 0.0))
+        if lag > self.ppq * env.factor:
+            metrics.get_metrics().inc("realtime_lag_total")
+            lag_log.warning(
+                "behind real time beat=%d lag=%.3fs", env.now // self.ppq, lag
+            )
 
 
 class Player:
-    def __init__(self, env, name="player", rules={}, participation=[]):
+    def __init__(
+        self,
+        env,
+        name="player",
+        rules={},
+        participation=[],
+        raga=raga_bhairav,
+        channel=None,
+        lookahead=0,
+    ):
         self.env = env
         self.name = name
         self.mood = None
         self.rules = rules
         self.participation = participation
+        # each player gets its own voice of the raga, so mood rules written by
+        # checkmood never leak into another player's
+        self.raga = raga.voice(channel=channel)
+        self.conductor = None
+        # with lookahead, the next phrases are composed on a worker thread
+        self.buffer = PhraseBuffer(self.raga, lookahead) if lookahead else None
+        self._applied_mood = None
 
     # 		raga["base_duration_rule"]=lambda x: 0.5
 
+    def seed(self, seed):
+        # This player's raga draws from a stream named after the player
+        self.raga.seed(seed, "player", self.name)
+
     def play_raga(self):
+        env = self.env
+        ppq = self.raga.ppq
         while 1:
             if not self.mood:
-                nextbeat = round(env.now + 0.5)
-                wait = nextbeat - env.now if (nextbeat - env.now) > 0 else 1
+                wait = ppq - env.now % ppq  # up to the next beat
                 yield self.env.timeout(wait)  # Wait a beat before checking again
                 continue
             self.checkmood()
-            lengthinsecs = raga.play()
-            secondsperbeat = 60 / raga.bpm
-            lengthinbeats = lengthinsecs / secondsperbeat
+            if self.conductor is not None:
+                lengthinticks = yield self.conductor.request(self)
+            else:
+                lengthinticks = self.perform()
+            lengthinbeats = lengthinticks / ppq
 
-            print(
-                f"Playing {self.name} at time {self.env.now} for {lengthinbeats} with {self.mood} mood."
+            log.info(
+                "playing player=%s beat=%s beats=%s mood=%s",
+                self.name,
+                self.env.now / ppq,
+                lengthinbeats,
+                self.mood,
             )
             yield self.env.timeout(
-                lengthinbeats
+                lengthinticks
             )  # Simulate the time taken to play the raga
 
         return
 
+    def perform(self):
+        # Start the next stretch of music and return its length in ticks
+        start = time.perf_counter()
+        batches = {}
+        midi_sequence, playing_ticks = self.compose()
+        self.submit(midi_sequence, start, batches)
+        for engine, batch in batches.items():
+            engine.submit_many(batch)
+        return playing_ticks
+
+    def compose(self):
+        if self.buffer is not None:
+            return self.buffer.get()
+        return self.raga.compose()
+
+    def submit(self, midi_sequence, start, batches):
+        # Queue a composed sequence for sending; batches maps each playback
+        # engine to the (events, start) pairs going to it this tick
+        batches.setdefault(self.raga.engine, []).append(
+            (sequence_events(midi_sequence), start)
+        )
+
     def checkmood(self):
+        if self.buffer is None:
+            self.applymood()
+        elif self.mood != self._applied_mood:
+            self.buffer.invalidate(self.applymood)
+
+    def applymood(self):
+        self._applied_mood = self.mood
         mood = self.mood
         rules = self.rules
         if mood in self.rules:
             rules = self.rules[mood]
             for rule_key, rule_value in rules.items():
-                raga.rules[rule_key] = rule_value
+                self.raga.rules[rule_key] = rule_value
 
         return
 
 
-# SimPy Environment
-beat = 60 / raga.bpm
-env = simpy.rt.RealtimeEnvironment(factor=beat, strict=True)
-
-schedule = [
-    scheduledevent("alaap", 0, "slow"),
-    scheduledevent("elaboration", 30, "developing"),
-    scheduledevent("development", 60, "paced"),
-]
-
-conductor = conductor(env, schedule)
-
-# Usage
-participation = ["alaap", "elaboration", "development"]
-rules = {
-    "slow": {
-        "base_duration_rule": lambda x: 1.5 * beat,
-        "phrase_velocity_rule": lambda x: random.randint(0, 50),
-    },
-    "developing": {
-        "base_duration_rule": lambda x: 1.0 * beat,
-        "phrase_velocity_rule": lambda x: random.randint(50, 70),
-    },
-    "paced": {
-        "base_duration_rule": lambda x: 0.5 * beat,
-        "phrase_velocity_rule": lambda x: random.randint(70, 127),
-    },
-}
-player = Player(env, name="Sitarist", participation=participation, rules=rules)
-conductor.addplayer(player)
-env.process(conductor.begin())
-
-# Run the simulation
-env.run(until=80)
+def default_schedule():
+    return [
+        scheduledevent("alaap", 0, "slow"),
+        scheduledevent("elaboration", 30, "developing"),
+        scheduledevent("development", 60, "paced"),
+    ]
+
+
+def default_rules(beat):
+    return {
+        "slow": {
+            "base_duration_rule": lambda x: 1.5 * beat,
+            "phrase_velocity_rule": lambda x: x["rng"].randint(0, 50),
+        },
+        "developing": {
+            "base_duration_rule": lambda x: 1.0 * beat,
+            "phrase_velocity_rule": lambda x: x["rng"].randint(50, 70),
+        },
+        "paced": {
+            "base_duration_rule": lambda x: 0.5 * beat,
+            "phrase_velocity_rule": lambda x: x["rng"].randint(70, 127),
+        },
+    }
+
+
+default_participation = ["alaap", "elaboration", "development"]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+    if METRICS_PORT is not None:
+        metrics.enable().serve(METRICS_PORT)
+
+    raga = raga_bhairav
+
+    # SimPy Environment
+    beat = 60 / raga.bpm
+    # the clock counts ticks; conductor.checklag reports falling behind
+    env = simpy.rt.RealtimeEnvironment(factor=beat / raga.ppq, strict=False)
+
+    band = conductor(env, default_schedule(), raga=raga, ppq=raga.ppq)
+
+    # Usage
+    player = Player(
+        env,
+        name="Sitarist",
+        participation=default_participation,
+        rules=default_rules(beat),
+        raga=raga,
+        lookahead=2,
+    )
+    band.addplayer(player)
+    env.process(band.begin())
+
+    # Run the simulation
+    env.run(until=beats_to_ticks(80, raga.ppq))
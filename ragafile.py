@@ -0,0 +1,408 @@
+# Declarative raga definitions. A raga is described in a TOML or JSON file
+# (scales, shruti ratios, keyswitches, phrase library and parametric rules),
+# validated, compiled into a ready-to-render Raga and cached on disk by the
+# file's hash, so loading a library of ragas is mostly unpickling.
+import hashlib
+import json
+import os
+import pickle
+import tomllib
+from fractions import Fraction
+
+import numpy as np
+
+import variation
+from gamak import GLIDE_SHAPES, SHAPES
+from main import Note, Phrase, Raga
+from markov import MarkovSelectionRule, phrase_indices
+from rng import make_rng
+from selection import TalSelector
+from templates import RENDER_VERSION
+
+# Bump when compiled ragas change shape: 2 for the array-backed phrase library,
+# slotted notes, dedupe and the phrase index; 3 for the selection history.
+FORMAT_VERSION = 3
+EXTENSIONS = (".toml", ".json")
+
+
+# Parametric rules. These are classes rather than closures so compiled ragas
+# can be pickled.
+
+
+class ConstantRule:
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self, params):
+        return self.value
+
+
+class RandomIntRule:
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+
+    def __call__(self, params):
+        return params["rng"].randint(self.low, self.high)
+
+
+class ArchVelocityRule:
+    """Velocity rising from `low` to `high` at the middle of the sequence and back."""
+
+    vectorized = True
+
+    def __init__(self, low=60, high=127, scale=0.5):
+        self.low = low
+        self.high = high
+        self.scale = scale
+
+    def __call__(self, params):
+        note_index = np.asarray(params["note_index"])
+        midpoint = params["total_notes"] / 2
+        span = self.high - self.low
+        rising = self.low + (note_index / midpoint) * span
+        falling = self.high - ((note_index - midpoint) / midpoint) * span
+        velocity = np.where(note_index < midpoint, rising, falling).astype(int)
+        velocity = (velocity * self.scale).astype(int)
+        return velocity if velocity.ndim else int(velocity)
+
+
+class TalSelectionRule:
+    """`count` phrases that together fill whole tal cycles."""
+
+    def __init__(self, count=3):
+        self.count = count
+
+    def __call__(self, params):
+        raga = params["raga"]
+        base_duration = params["base_duration"]
+        selector = raga.library_cache(
+            ("tal", raga.tal, raga.bpm, raga.ppq, base_duration, self.count),
+            lambda: TalSelector(
+                raga.phrases,
+                raga.tal,
+                raga.bpm,
+                base_duration,
+                count=self.count,
+                ppq=raga.ppq,
+            ),
+        )
+        return selector.sample(params["rng"])
+
+
+class UniformSelectionRule:
+    def __init__(self, count=1):
+        self.count = count
+
+    def __call__(self, params):
+        phrases = params["raga"].phrases
+        return params["rng"].sample(phrases, min(self.count, len(phrases)))
+
+
+RULE_TYPES = {
+    "constant": ConstantRule,
+    "random_int": RandomIntRule,
+    "arch": ArchVelocityRule,
+    "tal": TalSelectionRule,
+    "uniform": UniformSelectionRule,
+    "markov": MarkovSelectionRule,
+}
+
+RULE_SLOTS = {
+    "base_duration": "base_duration_rule",
+    "base_velocity": "base_velocity_rule",
+    "phrase_velocity": "phrase_velocity_rule",
+    "phrase_selection": "phrase_selection_rule",
+}
+
+
+def parse(path, data):
+    if path.endswith(".toml"):
+        return tomllib.loads(data.decode())
+    if path.endswith(".json"):
+        return json.loads(data)
+    raise ValueError(f"{path}: unknown raga file type, expected one of {EXTENSIONS}")
+
+
+def _ratio(value, where):
+    # shruti ratios may be written as numbers or as "16/15"
+    try:
+        return float(Fraction(value)) if isinstance(value, str) else float(value)
+    except (ValueError, ZeroDivisionError):
+        raise ValueError(f"{where}: {value!r} is not a frequency ratio")
+
+
+def _require(condition, message):
+    if not condition:
+        raise ValueError(message)
+
+
+def _number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _whole(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _table(spec, key, path):
+    value = spec.get(key, {})
+    _require(isinstance(value, dict), f"{path}: {key} must be a table")
+    return value
+
+
+# settings tables and the values each of their keys takes
+WOBBLE_SETTINGS = {
+    "depth": _number,
+    "rate": lambda value: _number(value) and value > 0,
+    "shape": lambda value: value in SHAPES,
+    "control_rate": lambda value: _number(value) and value > 0,
+}
+GLIDE_SETTINGS = {
+    "steps": lambda value: _whole(value) and value > 0,
+    "shape": lambda value: value in GLIDE_SHAPES,
+    "hold": lambda value: _number(value) and 0 <= value < 1,
+    "start_bend": _whole,
+}
+
+
+def _settings(spec, key, allowed, path):
+    for name, value in _table(spec, key, path).items():
+        where = f"{path}: {key}.{name}"
+        _require(name in allowed, f"{where}: unknown setting, expected {list(allowed)}")
+        _require(allowed[name](value), f"{where}: {value!r} is not a valid {name}")
+
+
+def validate(spec, path="<raga>"):
+    for key in ("name", "arohana", "avarohana", "phrases"):
+        _require(key in spec, f"{path}: missing {key!r}")
+    _require(
+        isinstance(spec["name"], str) and spec["name"], f"{path}: name must be text"
+    )
+    bpm = spec.get("bpm", 120)
+    _require(_number(bpm) and bpm > 0, f"{path}: bpm must be a positive number")
+    for key in ("tal", "ppq"):
+        if key in spec:
+            _require(
+                _whole(spec[key]) and spec[key] > 0,
+                f"{path}: {key} must be a positive whole number",
+            )
+
+    for key in ("arohana", "avarohana"):
+        scale = spec[key]
+        _require(
+            isinstance(scale, list)
+            and scale
+            and all(isinstance(n, int) and 0 <= n <= 127 for n in scale),
+            f"{path}: {key} must be a list of MIDI note numbers",
+        )
+    _require(
+        len(spec["arohana"]) == len(spec["avarohana"]),
+        f"{path}: arohana and avarohana must have the same number of steps",
+    )
+
+    meendh_map = _table(spec, "meendh_map", path)
+    for name, note in meendh_map.items():
+        _require(
+            isinstance(note, int) and 0 <= note <= 127,
+            f"{path}: meendh_map[{name!r}] must be a MIDI note number",
+        )
+    meendh_bends = _table(spec, "meendh_bends", path)
+    for name, steps in meendh_bends.items():
+        _require(
+            _whole(steps), f"{path}: meendh_bends[{name!r}] must be a number of steps"
+        )
+    _settings(spec, "wobble", WOBBLE_SETTINGS, path)
+    _settings(spec, "glide", GLIDE_SETTINGS, path)
+    known_meendhs = set(meendh_map) | set(meendh_bends)
+
+    for step, ratio in _table(spec, "step_frequencies", path).items():
+        _require(
+            str(step).lstrip("-").isdigit(),
+            f"{path}: step_frequencies key {step!r} is not a scale step",
+        )
+        _ratio(ratio, f"{path}: step_frequencies[{step!r}]")
+
+    for slot, rule in _table(spec, "rules", path).items():
+        where = f"{path}: rules.{slot}"
+        _require(
+            slot in RULE_SLOTS, f"{where}: unknown rule, expected {list(RULE_SLOTS)}"
+        )
+        _require(
+            isinstance(rule, dict) and rule.get("type") in RULE_TYPES,
+            f"{where}: type must be one of {list(RULE_TYPES)}",
+        )
+        if rule["type"] == "markov":
+            _validate_transitions(rule, where)
+
+    _require(isinstance(spec["phrases"], list), f"{path}: phrases must be a list")
+    for i, entry in enumerate(spec["phrases"]):
+        where = f"{path}: phrases[{i}]"
+        _require(isinstance(entry, dict), f"{where}: must be a table")
+        _require(isinstance(entry.get("notes"), list), f"{where}: missing notes")
+        for j, note in enumerate(entry["notes"]):
+            _require(
+                isinstance(note, list)
+                and len(note) in (2, 3)
+                and isinstance(note[0], int)
+                and isinstance(note[1], (int, float))
+                and note[1] > 0,
+                f"{where}.notes[{j}]: expected [increment, duration(, meendh)]",
+            )
+            if len(note) == 3:
+                _require(
+                    note[2] in known_meendhs,
+                    f"{where}.notes[{j}]: unknown meendh {note[2]!r}",
+                )
+        variants = entry.get("variants", 0)
+        _require(
+            _whole(variants) and variants >= 0,
+            f"{where}: variants must be a whole number",
+        )
+
+    library = _table(spec, "library", path)
+    _require(
+        _whole(library.get("seed", 0)), f"{path}: library.seed must be a whole number"
+    )
+    start_steps = library.get("start_steps", [0, 7])
+    _require(
+        isinstance(start_steps, list) and all(_whole(step) for step in start_steps),
+        f"{path}: library.start_steps must be a list of scale steps",
+    )
+
+
+def _validate_transitions(rule, where):
+    # keys are phrase indices as text, e.g. "0", or "3,5" after two phrases
+    def weights(table, at):
+        _require(isinstance(table, dict), f"{at}: must be a table of weights")
+        for target, weight in table.items():
+            try:
+                indices = phrase_indices(target)
+            except ValueError:
+                indices = ()
+            _require(len(indices) == 1, f"{at}: {target!r} is not a phrase index")
+            _require(
+                _number(weight) and weight >= 0,
+                f"{at}[{target!r}]: weight must be a number of at least 0",
+            )
+        _require(
+            not table or sum(table.values()) > 0,
+            f"{at}: weights must not all be 0",
+        )
+
+    table = rule.get("table", {})
+    _require(isinstance(table, dict), f"{where}.table: must be a table")
+    for history, next_weights in table.items():
+        try:
+            phrase_indices(history)
+        except ValueError:
+            raise ValueError(
+                f"{where}.table: {history!r} is not a phrase index"
+            ) from None
+        weights(next_weights, f"{where}.table[{history!r}]")
+    weights(rule.get("initial", {}), f"{where}.initial")
+
+
+def build_rule(rule, where):
+    params = {key: value for key, value in rule.items() if key != "type"}
+    try:
+        return RULE_TYPES[rule["type"]](**params)
+    except TypeError as e:
+        raise ValueError(f"{where}: {e}")
+
+
+def compile_raga(spec, path="<raga>"):
+    validate(spec, path)
+
+    rules = {
+        RULE_SLOTS[slot]: build_rule(rule, f"{path}: rules.{slot}")
+        for slot, rule in spec.get("rules", {}).items()
+    }
+    meendh_map = dict(spec.get("meendh_map", {}))
+    raga = Raga(
+        spec["name"],
+        list(spec["arohana"]),
+        list(spec["avarohana"]),
+        tal=spec.get("tal", 4),
+        bpm=spec.get("bpm", 120),
+        rules=rules,
+        meendhMap=meendh_map,
+        step_frequencies={
+            int(step): _ratio(ratio, path)
+            for step, ratio in spec.get("step_frequencies", {}).items()
+        },
+        wobble=spec.get("wobble"),
+        meendh_bends=spec.get("meendh_bends"),
+        glide=spec.get("glide"),
+        **({"ppq": spec["ppq"]} if "ppq" in spec else {}),
+    )
+
+    # Variants come from a fixed stream, so a file always gives the same library
+    library = spec.get("library", {})
+    rng = make_rng(library.get("seed", 0), spec["name"].lower(), "library")
+    for entry in spec["phrases"]:
+        phrase = Phrase([Note(*note) for note in entry["notes"]])
+        raga.add_phrase(phrase)
+        for _ in range(entry.get("variants", 0)):
+            raga.add_phrase(variation.mutate_phrase(phrase, list(meendh_map), rng))
+
+    for slot in spec.get("rules", {}):
+        rule = rules[RULE_SLOTS[slot]]
+        if isinstance(rule, MarkovSelectionRule):
+            unknown = sorted(i for i in rule.indices() if i >= len(raga.phrases))
+            _require(
+                not unknown,
+                f"{path}: rules.{slot}: phrase indices {unknown} are past the "
+                f"{len(raga.phrases)} phrases in the library",
+            )
+
+    # Work out everything render time would otherwise build on first use
+    for phrase in raga.phrases:
+        for step in library.get("start_steps", [0, 7]):
+            raga.template(phrase, step)
+    raga.bend_table
+    raga.fingerprint
+    return raga
+
+
+def default_cache_dir(path):
+    return os.path.join(os.path.dirname(os.path.abspath(path)), "__pycache__")
+
+
+def load_raga(path, cache_dir=None, use_cache=True):
+    with open(path, "rb") as f:
+        data = f.read()
+
+    # compiled templates and their cache keys embed RENDER_VERSION too
+    version = f"{FORMAT_VERSION}:{RENDER_VERSION}:"
+    digest = hashlib.sha256(version.encode() + data).hexdigest()
+    cache_dir = cache_dir if cache_dir is not None else default_cache_dir(path)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    cached = os.path.join(cache_dir, f"{stem}.{digest[:16]}.raga.pickle")
+
+    if use_cache:
+        try:
+            with open(cached, "rb") as f:
+                return pickle.load(f)
+        except Exception:
+            pass  # missing, partial or stale: compile afresh
+
+    raga = compile_raga(parse(path, data), path)
+
+    if use_cache:
+        os.makedirs(cache_dir, exist_ok=True)
+        partial = f"{cached}.{os.getpid()}"
+        with open(partial, "wb") as f:
+            pickle.dump(raga, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(partial, cached)
+    return raga
+
+
+def load_library(directory, cache_dir=None):
+    # Every raga file in a directory, by raga name
+    ragas = {}
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith(EXTENSIONS):
+            raga = load_raga(os.path.join(directory, filename), cache_dir)
+            ragas[raga.name] = raga
+    return ragas
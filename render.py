@@ -0,0 +1,119 @@
+# Offline rendering: run the conductor/Player schedule on a plain (non-realtime)
+# SimPy clock and write what the players would have played into a MIDI file.
+import mido
+import simpy
+
+from main import sequence_events
+from player import (
+    Player,
+    conductor,
+    default_participation,
+    default_rules,
+    default_schedule,
+)
+from timing import PPQ, beats_to_ticks, seconds_to_ticks
+
+
+class MidiFileWriter:
+    """Collects timestamped messages and writes them as a delta-timed track."""
+
+    def __init__(self, bpm, ticks_per_beat=PPQ):
+        self.bpm = bpm
+        self.ticks_per_beat = ticks_per_beat
+        self.events = []  # (absolute tick, order, message)
+
+    def add(self, start_tick, midi_sequence):
+        # start_tick is the clock position the sequence starts playing at;
+        # message times are seconds, so this is where they become ticks
+        for offset, msg in sequence_events(midi_sequence):
+            tick = start_tick + seconds_to_ticks(offset, self.bpm, self.ticks_per_beat)
+            self.events.append((tick, len(self.events), msg))
+
+    def to_midifile(self):
+        mid = mido.MidiFile(ticks_per_beat=self.ticks_per_beat)
+        track = mido.MidiTrack()
+        mid.tracks.append(track)
+        track.append(mido.MetaMessage("set_tempo", tempo=mido.bpm2tempo(self.bpm)))
+
+        last_tick = 0
+        for tick, _, msg in sorted(self.events, key=lambda e: e[:2]):
+            track.append(msg.copy(time=tick - last_tick))
+            last_tick = tick
+        track.append(mido.MetaMessage("end_of_track", time=0))
+        return mid
+
+
+class OfflinePlayer(Player):
+    """A Player that writes its phrases into a MidiFileWriter instead of a port."""
+
+    def __init__(self, env, writer, **kwargs):
+        super().__init__(env, **kwargs)
+        self.writer = writer
+
+    def perform(self):
+        midi_sequence, playing_ticks = self.compose()
+        self.writer.add(self.env.now, midi_sequence)
+        return playing_ticks
+
+    def submit(self, midi_sequence, start, batches):
+        self.writer.add(self.env.now, midi_sequence)
+
+
+def render_performance(
+    raga,
+    schedule=None,
+    rules=None,
+    participation=None,
+    until=80,
+    path=None,
+    name="player",
+    seed=None,
+    voices=None,
+):
+    # Same schedule as player.py, but as fast as the CPU allows. until is in
+    # beats; the clock itself counts ticks.
+    # voices is a list of Player keyword dicts (name, rules, participation,
+    # channel, raga) for an ensemble; by default there is one player.
+    beat = 60 / raga.bpm
+    env = simpy.Environment()
+    writer = MidiFileWriter(raga.bpm, raga.ppq)
+
+    band = conductor(
+        env,
+        schedule if schedule is not None else default_schedule(),
+        ppq=raga.ppq,
+    )
+    if voices is None:
+        voices = [
+            {
+                "name": name,
+                "participation": (
+                    participation
+                    if participation is not None
+                    else default_participation
+                ),
+                "rules": rules if rules is not None else default_rules(beat),
+            }
+        ]
+    for voice in voices:
+        player = OfflinePlayer(env, writer, **{"raga": raga, **voice})
+        if seed is not None:
+            player.seed(seed)
+        band.addplayer(player)
+    env.process(band.begin())
+    env.run(until=beats_to_ticks(until, raga.ppq))
+
+    mid = writer.to_midifile()
+    if path is not None:
+        mid.save(path)
+    return mid
+
+
+if __name__ == "__main__":
+    import sys
+
+    from bhairav import raga_bhairav
+
+    out = sys.argv[1] if len(sys.argv) > 1 else "bhairav.mid"
+    render_performance(raga_bhairav, path=out)
+    print("Wrote", out)
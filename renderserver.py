@@ -0,0 +1,425 @@
+# A long-running local render server. Worker processes import and compile the
+# ragas once and then render on request, so a client pays milliseconds per
+# performance instead of the start-up cost of importing everything.
+#
+# Protocol: one JSON object per line. A render request is
+#   {"id": 1, "raga": "bhairav", "seed": 7, "beats": 80,
+#    "schedule": [{"name": "alaap", "time": 0, "mood": "slow"}, ...],
+#    "rules": "name", "format": "midi" or "events"}
+# and the reply is one JSON header line, followed by `size` bytes of MIDI
+# file, or by `count` lines of [tick, [midi bytes]] for events.
+# Only the ragas the server was started with are rendered, and "rules" names
+# an entry in the server's own registry of mood rules, so clients never choose
+# what the workers import or call.
+# {"op": "stats"} replies with queue and worker counts. Errors reply
+# {"ok": false, "error": ...}, with "busy": true when the queue stayed full.
+import argparse
+import asyncio
+import json
+import os
+import queue
+import socket
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import mido
+
+import batch
+from player import scheduledevent
+
+DEFAULT_ADDRESS = "127.0.0.1:8765"
+MAX_BEATS = 1000  # longest performance one request may ask for
+
+
+class ServerBusy(TimeoutError):
+    """The render queue stayed full for the whole queue timeout."""
+
+
+def parse_address(address):
+    # "unix:/path/to/socket" or "host:port"
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:") :]
+    host, _, port = address.rpartition(":")
+    return socket.AF_INET, (host or "127.0.0.1", int(port))
+
+
+# Worker side. These run in the pool's processes; the ragas they load stay
+# imported and compiled for every later request.
+
+
+def warm(raga_specs, rules_specs=()):
+    for spec in raga_specs:
+        batch.load_raga(spec)
+    for spec in rules_specs:
+        batch.load_object(spec)
+
+
+def render_request(request, cache_dir=None):
+    schedule = request.get("schedule")
+    if schedule is not None:
+        schedule = [
+            scheduledevent(item["name"], item["time"], item["mood"])
+            for item in schedule
+        ]
+    args = (
+        request["raga"],
+        int(request.get("seed", 0)),
+        schedule,
+        request.get("beats", 80),
+        request.get("rules"),
+    )
+    if request.get("format", "midi") == "events":
+        events = []
+        tick = 0
+        for msg in batch.render_midi(*args).tracks[0]:
+            tick += msg.time
+            if not msg.is_meta:
+                events.append((tick, msg.bytes()))
+        return events
+    return batch.render_bytes(*args, cache_dir=cache_dir)
+
+
+class RenderServer:
+    """
+    Accepts requests from any number of connections into a bounded queue,
+    which `workers` dispatchers drain into a process pool. When the queue is
+    full, a connection's next request waits up to `queue_timeout` seconds
+    and is then refused as busy, so load sheds instead of piling up.
+
+    Requests may only name ragas in `ragas` and mood rules in `rules`, a
+    mapping of names to "module:function" specs; both are loaded when the
+    workers start. A request may ask for at most `max_beats` beats, so
+    no one render holds a worker for long.
+    """
+
+    def __init__(
+        self,
+        address=DEFAULT_ADDRESS,
+        ragas=("bhairav",),
+        rules=None,
+        workers=None,
+        max_beats=MAX_BEATS,
+        queue_size=64,
+        queue_timeout=5.0,
+        cache_dir=None,
+    ):
+        self.address = address
+        self.ragas = tuple(ragas)
+        self.rules = dict(rules or {})  # name -> "module:function" mood rules
+        self.workers = workers or os.cpu_count() or 1
+        self.max_beats = max_beats
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.cache_dir = cache_dir
+        self.served = 0
+        self.refused = 0
+        self.failed = 0
+        self._pool = None
+        self._queue = None
+        self._server = None
+        self._dispatchers = []
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        warmup = (self.ragas, tuple(self.rules.values()))
+        self._pool = ProcessPoolExecutor(
+            self.workers, initializer=warm, initargs=warmup
+        )
+        # start every worker now, so the first requests don't pay for imports
+        await asyncio.gather(
+            *(
+                loop.run_in_executor(self._pool, warm, *warmup)
+                for _ in range(self.workers)
+            )
+        )
+        self._queue = asyncio.Queue(self.queue_size)
+        self._dispatchers = [
+            loop.create_task(self._dispatch()) for _ in range(self.workers)
+        ]
+
+        family, where = parse_address(self.address)
+        if family == socket.AF_UNIX:
+            if os.path.exists(where):
+                os.unlink(where)
+            self._server = await asyncio.start_unix_server(self._handle, where)
+        else:
+            self._server = await asyncio.start_server(self._handle, *where)
+        return self
+
+    async def serve_forever(self):
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for task in self._dispatchers:
+            task.cancel()
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize(),
+            "queue_size": self.queue_size,
+            "workers": self.workers,
+            "ragas": list(self.ragas),
+            "rules": sorted(self.rules),
+            "served": self.served,
+            "refused": self.refused,
+            "failed": self.failed,
+        }
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            request, future = await self._queue.get()
+            try:
+                result = await loop.run_in_executor(
+                    self._pool, render_request, request, self.cache_dir
+                )
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self._queue.task_done()
+
+    def resolve(self, request):
+        # The request as a worker runs it, with rules looked up by name;
+        # anything the server was not configured with is refused
+        if request.get("raga") not in self.ragas:
+            raise ValueError(f"Raga {request.get('raga')!r} is not served here")
+        if request.get("format", "midi") not in ("midi", "events"):
+            raise ValueError(f"Unknown format {request['format']!r}")
+        beats = request.get("beats", 80)
+        if not (
+            isinstance(beats, (int, float))
+            and not isinstance(beats, bool)
+            and 0 < beats <= self.max_beats
+        ):
+            raise ValueError(f"beats must be above 0 and at most {self.max_beats}")
+        seed = request.get("seed", 0)
+        if not isinstance(seed, int) or isinstance(seed, bool):
+            raise ValueError("seed must be a whole number")
+        name = request.get("rules")
+        if name is not None:
+            if name not in self.rules:
+                raise ValueError(f"Unknown rules {name!r}")
+            request = dict(request, rules=self.rules[name])
+        return request
+
+    async def render(self, request):
+        request = self.resolve(request)
+        future = asyncio.get_running_loop().create_future()
+        try:
+            await asyncio.wait_for(
+                self._queue.put((request, future)), self.queue_timeout
+            )
+        except asyncio.TimeoutError:
+            self.refused += 1
+            raise ServerBusy("Render queue is full") from None
+        return await future
+
+    async def _handle(self, reader, writer):
+        # requests on one connection are answered in order
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                await self._answer(line, writer)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _answer(self, line, writer):
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get("id")
+            if request.get("op", "render") == "stats":
+                header = {"id": request_id, "ok": True, "stats": self.stats()}
+                writer.write(json.dumps(header).encode() + b"\n")
+                return
+            result = await self.render(request)
+        except ServerBusy as e:
+            reply = {"id": request_id, "ok": False, "error": str(e), "busy": True}
+            writer.write(json.dumps(reply).encode() + b"\n")
+            return
+        except Exception as e:
+            self.failed += 1
+            reply = {"id": request_id, "ok": False, "error": f"{type(e).__name__}: {e}"}
+            writer.write(json.dumps(reply).encode() + b"\n")
+            return
+
+        self.served += 1
+        if isinstance(result, bytes):
+            header = {"id": request_id, "ok": True, "format": "midi"}
+            header["size"] = len(result)
+            writer.write(json.dumps(header).encode() + b"\n" + result)
+        else:
+            header = {"id": request_id, "ok": True, "format": "events"}
+            header["count"] = len(result)
+            writer.write(json.dumps(header).encode() + b"\n")
+            for event in result:
+                writer.write(json.dumps(event).encode() + b"\n")
+
+
+class RenderClient:
+    """
+    Blocking client with a pool of up to `pool_size` persistent connections,
+    safe to share between threads.
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, pool_size=4, timeout=60.0):
+        self.address = address
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._ids = iter(range(1, 1 << 62))
+        self._ids_lock = threading.Lock()
+
+    def _connect(self):
+        family, where = parse_address(self.address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(where)
+        return sock, sock.makefile("rwb")
+
+    def request(self, payload):
+        # Sends one request and returns (header, body); body is bytes for
+        # MIDI, a list for events and None otherwise
+        with self._ids_lock:
+            payload = dict(payload, id=next(self._ids))
+        self._slots.acquire()
+        try:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                connection = self._connect()
+            sock, stream = connection
+            try:
+                stream.write(json.dumps(payload).encode() + b"\n")
+                stream.flush()
+                header = json.loads(stream.readline() or b"null")
+                if header is None:
+                    raise ConnectionError("Render server closed the connection")
+                body = None
+                if header.get("format") == "midi":
+                    body = stream.read(header["size"])
+                elif header.get("format") == "events":
+                    body = [
+                        json.loads(stream.readline()) for _ in range(header["count"])
+                    ]
+            except BaseException:
+                stream.close()
+                sock.close()
+                raise
+            self._idle.put(connection)
+        finally:
+            self._slots.release()
+
+        if not header.get("ok"):
+            if header.get("busy"):
+                raise TimeoutError(header["error"])
+            raise RuntimeError(header.get("error", "Render failed"))
+        return header, body
+
+    def _render(self, raga, seed, schedule, beats, rules, format):
+        request = {"raga": raga, "seed": seed, "beats": beats, "format": format}
+        if schedule is not None:
+            request["schedule"] = [
+                item
+                if isinstance(item, dict)
+                else {"name": item.name, "time": item.time, "mood": item.mood}
+                for item in schedule
+            ]
+        if rules is not None:
+            request["rules"] = rules
+        return self.request(request)[1]
+
+    def render(self, raga="bhairav", seed=0, schedule=None, beats=80, rules=None):
+        # MIDI file bytes
+        return self._render(raga, seed, schedule, beats, rules, "midi")
+
+    def events(self, raga="bhairav", seed=0, schedule=None, beats=80, rules=None):
+        # [(tick, mido.Message), ...] in tick order
+        return [
+            (tick, mido.Message.from_bytes(data))
+            for tick, data in self._render(raga, seed, schedule, beats, rules, "events")
+        ]
+
+    def stats(self):
+        return self.request({"op": "stats"})[0]["stats"]
+
+    def close(self):
+        while True:
+            try:
+                sock, stream = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            stream.close()
+            sock.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve raga renders locally")
+    parser.add_argument(
+        "--address", default=DEFAULT_ADDRESS, help='"host:port" or "unix:/path"'
+    )
+    parser.add_argument(
+        "--raga",
+        action="append",
+        help="raga to keep loaded (module spec or raga file); repeatable",
+    )
+    parser.add_argument(
+        "--rules",
+        action="append",
+        default=[],
+        help='mood rules clients may ask for, as "name=module:function"; repeatable',
+    )
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--queue", type=int, default=64, help="max queued requests")
+    parser.add_argument(
+        "--max-beats",
+        type=float,
+        default=MAX_BEATS,
+        help="longest performance a request may ask for",
+    )
+    parser.add_argument("--cache", help="directory to reuse finished renders from")
+    args = parser.parse_args(argv)
+    if any("=" not in item for item in args.rules):
+        parser.error('--rules takes "name=module:function"')
+
+    server = RenderServer(
+        args.address,
+        ragas=args.raga or ["bhairav"],
+        rules=dict(item.split("=", 1) for item in args.rules),
+        workers=args.workers,
+        max_beats=args.max_beats,
+        queue_size=args.queue,
+        cache_dir=args.cache,
+    )
+
+    async def run():
+        await server.start()
+        print(f"Serving {', '.join(server.ragas)} on {args.address}")
+        try:
+            await server.serve_forever()
+        finally:
+            await server.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# Absolute-deadline playback: every event is due at start + offset on one
+# monotonic clock, so send and sleep errors never add up across a phrase.
+import time
+
+from metrics import get_metrics
+
+LATE_POLICIES = ("catchup", "drop")
+
+
+class JitterStats:
+    """Scheduled-versus-actual send times for a run of events, in seconds."""
+
+    def __init__(self):
+        self.jitter = []  # actual - scheduled, per sent event
+        self.dropped = 0
+        self.late = 0
+
+    def record(self, lateness):
+        self.jitter.append(lateness)
+
+    def percentile(self, p):
+        if not self.jitter:
+            return 0.0
+        ordered = sorted(self.jitter)
+        index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def summary(self):
+        return {
+            "events": len(self.jitter),
+            "late": self.late,
+            "dropped": self.dropped,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": max(self.jitter) if self.jitter else 0.0,
+        }
+
+
+class DeadlineScheduler:
+    """
+    Sends (offset, message) events at start + offset.
+
+    Waits with a coarse sleep until `spin` seconds before the deadline and then
+    spins for the rest. Events more than `late_threshold` seconds late are either
+    sent straight away ("catchup") or skipped ("drop"); note_offs are always
+    sent so nothing is left hanging.
+    """
+
+    def __init__(
+        self,
+        output,
+        late_policy="catchup",
+        spin=0.002,
+        late_threshold=0.02,
+        clock=time.perf_counter,
+        sleep=time.sleep,
+    ):
+        if late_policy not in LATE_POLICIES:
+            raise ValueError(f"Unknown late policy {late_policy!r}")
+        self.output = output
+        self.late_policy = late_policy
+        self.spin = spin
+        self.late_threshold = late_threshold
+        self.clock = clock
+        self.sleep = sleep
+
+    def wait_until(self, deadline):
+        clock = self.clock
+        remaining = deadline - clock()
+        if remaining > self.spin:
+            self.sleep(remaining - self.spin)
+        while clock() < deadline:
+            pass
+
+    def play(self, events, start=None, stats=None):
+        start = self.clock() if start is None else start
+        stats = stats if stats is not None else JitterStats()
+
+        for offset, msg in events:
+            deadline = start + offset
+            self.wait_until(deadline)
+            self.send_due(deadline, msg, stats)
+
+        return stats
+
+    def send_due(self, deadline, msg, stats):
+        # Send a message whose deadline has arrived, applying the late policy
+        metrics = get_metrics()
+        lateness = self.clock() - deadline
+        if lateness > self.late_threshold:
+            stats.late += 1
+            metrics.inc("events_late_total")
+            if self.late_policy == "drop" and msg.type != "note_off":
+                stats.dropped += 1
+                metrics.inc("events_dropped_total")
+                return False
+        self.output.send(msg)
+        stats.record(lateness)
+        metrics.inc("events_sent_total")
+        metrics.observe("send_lateness_seconds", max(lateness, 0.0))
+        return True
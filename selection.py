@@ -0,0 +1,157 @@
+# Phrase selection helpers. Tal fitting works in integer ticks and is indexed
+# once per phrase library, so a pick costs the same however many phrases there are.
+import random
+
+import numpy as np
+
+from timing import PPQ, seconds_to_ticks
+
+
+class AliasSampler:
+    """Walker/Vose alias table: O(1) draws from a fixed discrete distribution."""
+
+    def __init__(self, weights):
+        n = len(weights)
+        if n == 0:
+            raise ValueError("No weights to sample from")
+        total = float(sum(weights))
+        if total <= 0:
+            raise ValueError("Weights must sum to more than zero")
+        scaled = [w * n / total for w in weights]
+        self.prob = [0.0] * n
+        self.alias = [0] * n
+
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] = scaled[l] + scaled[s] - 1
+            (small if scaled[l] < 1 else large).append(l)
+        for i in large + small:
+            self.prob[i] = 1.0
+
+    def __len__(self):
+        return len(self.prob)
+
+    def sample(self, rng=random):
+        i = int(rng.random() * len(self.prob))
+        return i if rng.random() < self.prob[i] else self.alias[i]
+
+
+def phrase_ticks(phrase, base_duration, bpm, ppq=PPQ):
+    # Length of a phrase in whole ticks at the given base_duration (seconds),
+    # matching what the phrase's template renders to
+    base_ticks = seconds_to_ticks(base_duration, bpm, ppq)
+    return int(round(phrase.total_duration() * base_ticks))
+
+
+class TalSelector:
+    """
+    Uniform draws of `count` distinct phrases whose total length is a whole
+    number of tal cycles.
+
+    Phrases are bucketed by their length modulo one tal cycle, and ways[k][s]
+    counts the ordered k-tuples of phrases (repeats allowed) whose residues
+    add up to s, built by dynamic programming over residues: one circular
+    convolution per extra phrase. A draw picks each phrase's residue in
+    proportion to the ways left to complete the cycle, so tuples come out
+    uniformly; tuples that repeat a phrase are drawn again, which leaves the
+    sets of distinct phrases uniform. When no combination fills whole cycles,
+    draws aim for the reachable total closest to a whole number of cycles.
+    """
+
+    attempts = 64  # draws before giving up on distinct phrases
+
+    def __init__(self, phrases, tal, bpm, base_duration, count=3, ppq=PPQ):
+        self.count = count
+        self.tal_ticks = tal * ppq
+        if hasattr(phrases, "total_durations"):
+            # a PhraseLibrary: every length in one array scan, and phrases are
+            # only turned into views once they are drawn
+            self.phrases = phrases
+            base_ticks = seconds_to_ticks(base_duration, bpm, ppq)
+            relative = phrases.total_durations()
+            self.ticks = np.rint(relative * base_ticks).astype(np.int64).tolist()
+        else:
+            self.phrases = list(phrases)
+            self.ticks = [
+                phrase_ticks(phrase, base_duration, bpm, ppq) for phrase in self.phrases
+            ]
+
+        cycle = self.tal_ticks
+        residues = np.asarray(self.ticks, dtype=np.int64) % cycle
+        # phrase indices grouped by residue; bucket r is order[bounds[r]:bounds[r + 1]]
+        self._order = np.argsort(residues, kind="stable")
+        self._bounds = np.searchsorted(residues[self._order], np.arange(cycle + 1))
+        self.sizes = np.diff(self._bounds).astype(np.float64)
+
+        self.ways = [np.zeros(cycle), self.sizes]
+        self.ways[0][0] = 1
+        for _ in range(2, count + 1):
+            self.ways.append(circular_convolve(self.ways[-1], self.sizes))
+
+        # the residue a draw's total aims for: 0 when whole cycles are possible
+        reachable = np.flatnonzero(self.ways[count])
+        distance = np.minimum(reachable, cycle - reachable)
+        self.target = int(reachable[distance.argmin()]) if len(reachable) else None
+        self.exact = self.target == 0
+        # each ways[k] reversed and doubled, so ways[k][(left - r) % cycle]
+        # over every r is one slice
+        self._reversed = [np.tile(ways[::-1], 2) for ways in self.ways]
+        self._steps = {}  # (phrases left, residue left) -> cumulative weights
+
+    def _step(self, k, left):
+        # cumulative weights of the next phrase's residue, with k phrases
+        # (this one included) still to add up to `left`
+        cumulative = self._steps.get((k, left))
+        if cumulative is None:
+            start = self.tal_ticks - 1 - left
+            rest = self._reversed[k - 1][start : start + self.tal_ticks]
+            cumulative = np.cumsum(self.sizes * rest)
+            if k == self.count:
+                self._steps[(k, left)] = cumulative  # every draw starts here
+        return cumulative
+
+    def _pick(self, residue, rng):
+        first, last = self._bounds[residue], self._bounds[residue + 1]
+        return int(self._order[first + int(rng.random() * (last - first))])
+
+    def draw(self, rng=random):
+        # Indices of `count` phrases (perhaps repeated) totalling the target
+        chosen = []
+        left = self.target
+        for k in range(self.count, 1, -1):
+            cumulative = self._step(k, left)
+            point = rng.random() * cumulative[-1]
+            residue = min(
+                int(np.searchsorted(cumulative, point, side="right")),
+                self.tal_ticks - 1,
+            )
+            chosen.append(self._pick(residue, rng))
+            left = (left - residue) % self.tal_ticks
+        chosen.append(self._pick(left, rng))
+        return chosen
+
+    def sample(self, rng=random):
+        if len(self.phrases) <= self.count:
+            return list(self.phrases)
+        if self.target is not None:
+            for _ in range(self.attempts):
+                chosen = self.draw(rng)
+                if len(set(chosen)) == self.count:
+                    return [self.phrases[i] for i in chosen]
+        # only repeats reach the target; a bounded uniform pick
+        return [
+            self.phrases[i] for i in rng.sample(range(len(self.phrases)), self.count)
+        ]
+
+
+def circular_convolve(a, b):
+    # (a * b)[s] summed over residues modulo len(a); float64 keeps zeros exact
+    full = np.convolve(a, b)
+    result = full[: len(a)].copy()
+    result[: len(full) - len(a)] += full[len(a) :]
+    return result
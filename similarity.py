@@ -0,0 +1,280 @@
+# Exact and near-duplicate lookups over a PhraseLibrary. Exact lookups hash
+# each phrase's canonical key; similarity compares fixed-length contour and
+# rhythm features, searched through k-means cells once a library is big
+# enough that scanning every phrase would be slow.
+import zlib
+
+import numpy as np
+
+POINTS = 8  # times per phrase the contour and rhythm are sampled at
+RHYTHM_WEIGHT = 4.0  # a rhythm fraction of 1/4 counts as much as one scale step
+DIMENSIONS = 2 * POINTS + 1
+
+
+def features(increments, durations, offsets, points=POINTS):
+    """
+    One row per phrase: the scale position sounding at `points` evenly spaced
+    moments, the fraction of notes started by each of them, and log2 of the
+    phrase's total relative duration.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    count = len(offsets) - 1
+    rows = np.zeros((count, 2 * points + 1), dtype=np.float32)
+    if not len(increments):
+        return rows
+    lengths = np.diff(offsets)
+    starts = offsets[:-1]
+    phrase_of = np.repeat(np.arange(count), lengths)
+
+    ends = np.concatenate(([0.0], np.cumsum(durations)))
+    onsets = ends[:-1] - ends[starts][phrase_of]
+    totals = ends[offsets[1:]] - ends[starts]
+    onsets = onsets / np.where(totals > 0, totals, 1)[phrase_of]
+
+    times = (np.arange(points) + 0.5) / points
+    started = (onsets[:, None] <= times).astype(np.int64)
+    counts = np.add.reduceat(started, np.minimum(starts, len(onsets) - 1))
+    empty = lengths == 0
+    counts[empty] = 0
+
+    positions = np.concatenate(([0], np.cumsum(increments)))
+    sounding = starts[:, None] + np.maximum(counts, 1)
+    contour = (
+        positions[np.minimum(sounding, len(increments))] - positions[starts][:, None]
+    )
+    contour[empty] = 0
+
+    rows[:, :points] = contour
+    rows[:, points:-1] = RHYTHM_WEIGHT * counts / np.maximum(lengths, 1)[:, None]
+    rows[:, -1] = np.log2(np.where(totals > 0, totals, 1))
+    return rows
+
+
+def phrase_features(phrase):
+    increments, durations, meendhs = phrase.columns()
+    return features(increments, durations, [0, len(meendhs)])[0]
+
+
+def _mix(x):
+    # splitmix64 finaliser; uint64 arithmetic wraps
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xBF58476D1CE4E5B9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def hashes(increments, durations, meendhs, offsets):
+    """
+    A 64-bit hash of each phrase's canonical key (increments, durations and
+    meendh names in order), stable across processes. meendhs holds one name
+    per note.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.diff(offsets)
+    count = len(lengths)
+    names = {name: zlib.crc32(repr(name).encode()) for name in set(meendhs)}
+    with np.errstate(over="ignore"):
+        position = np.arange(len(increments)) - np.repeat(offsets[:-1], lengths)
+        notes = _mix(
+            np.asarray(increments, dtype=np.int64).astype(np.uint64)
+            ^ _mix(np.asarray(durations, dtype=np.float64).view(np.uint64))
+            ^ _mix(
+                np.array([names[name] for name in meendhs], dtype=np.uint64)
+                + np.uint64(0x9E3779B97F4A7C15)
+            )
+            + position.astype(np.uint64) * np.uint64(0xD6E8FEB86659FD93)
+        )
+        totals = np.zeros(count, dtype=np.uint64)
+        if len(notes):
+            totals = np.add.reduceat(notes, np.minimum(offsets[:-1], len(notes) - 1))
+            totals[lengths == 0] = 0
+        return _mix(totals + lengths.astype(np.uint64))
+
+
+def library_hashes(library, start=0, end=None):
+    end = len(library) if end is None else end
+    offsets = library.offsets[start : end + 1]
+    first, last = int(offsets[0]), int(offsets[-1])
+    meendhs = library.meendhs
+    return hashes(
+        library.increments[first:last],
+        library.durations[first:last],
+        [meendhs[code] for code in library.meendh_codes[first:last].tolist()],
+        offsets - first,
+    )
+
+
+def phrase_hash(phrase):
+    increments, durations, meendhs = phrase.columns()
+    return int(hashes(increments, durations, meendhs, [0, len(meendhs)])[0])
+
+
+class PhraseIndex:
+    """
+    Lookups over a growing PhraseLibrary; update() takes in phrases added
+    since the last call.
+
+    Below `exact_below` phrases every query scans all features. Above it,
+    the features are split into k-means cells and a query scans only the
+    `probe` cells nearest to it, so results are approximate but fast.
+    Phrases added since the cells were laid out sit in a tail that every
+    query scans in full, so adding one never re-sorts the cells.
+    """
+
+    def __init__(self, library, probe=8, exact_below=4096, seed=0):
+        self.library = library
+        self.probe = probe
+        self.exact_below = exact_below
+        self.seed = seed
+        self.keys = {}  # phrase hash -> first index with it
+        self.features = np.empty((0, DIMENSIONS), dtype=np.float32)
+        self.size = 0
+        self._centroids = None
+        self._built_at = 0
+        self._cells = None  # (indices ordered by cell, start of each cell, rows)
+        self._assignment = np.empty(0, dtype=np.int64)
+        self._celled = 0  # phrases laid out in cells; the rest are the tail
+        self.update()
+
+    def __len__(self):
+        return self.size
+
+    def update(self):
+        library = self.library
+        start, end = self.size, len(library)
+        if start == end:
+            return
+        keys = self.keys
+        for i, key in enumerate(library_hashes(library, start, end).tolist(), start):
+            keys.setdefault(key, i)
+
+        offsets = library.offsets[start : end + 1]
+        first, last = int(offsets[0]), int(offsets[-1])
+        self.features = np.concatenate(
+            (
+                self.features,
+                features(
+                    library.increments[first:last],
+                    library.durations[first:last],
+                    offsets - first,
+                ),
+            )
+        )
+        self.size = end
+
+        if self.size >= self.exact_below and self.size >= 2 * self._built_at:
+            self._build()
+        elif self._centroids is not None and end - self._celled > self.exact_below:
+            # the tail has grown too long to scan; file it into the cells
+            self._assignment = np.concatenate(
+                (self._assignment, self._assign(self.features[self._celled :]))
+            )
+            self._layout()
+
+    def _build(self, iterations=8):
+        # Lloyd's k-means on a sample, with about sqrt(n) cells
+        rng = np.random.default_rng(self.seed)
+        cells = max(1, int(np.sqrt(self.size)))
+        sample = self.features[
+            rng.choice(self.size, size=min(self.size, 64 * cells), replace=False)
+        ]
+        centroids = sample[rng.choice(len(sample), size=cells, replace=False)]
+        for _ in range(iterations):
+            self._centroids = centroids
+            nearest = self._assign(sample)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, nearest, sample)
+            counts = np.bincount(nearest, minlength=cells)[:, None]
+            centroids = np.where(counts > 0, sums / np.maximum(counts, 1), centroids)
+        self._centroids = centroids.astype(np.float32)
+        self._assignment = self._assign(self.features)
+        self._built_at = self.size
+        self._layout()
+
+    def _layout(self):
+        # features laid out cell by cell, so a cell is one slice
+        order = np.argsort(self._assignment, kind="stable")
+        bounds = np.searchsorted(
+            self._assignment[order], np.arange(len(self._centroids) + 1)
+        )
+        self._cells = (order, bounds, self.features[order])
+        self._celled = len(self._assignment)
+
+    def _distances(self, rows):
+        # squared distance from each row to each centroid
+        centroids = self._centroids
+        return (
+            (rows * rows).sum(axis=1)[:, None]
+            - 2 * rows @ centroids.T
+            + (centroids * centroids).sum(axis=1)
+        )
+
+    def _assign(self, rows, chunk=8192):
+        # nearest cell per row, a chunk at a time to bound memory
+        return np.concatenate(
+            [
+                self._distances(rows[i : i + chunk]).argmin(axis=1)
+                for i in range(0, len(rows), chunk)
+            ]
+            or [np.empty(0, dtype=np.int64)]
+        )
+
+    def _candidates(self, row):
+        # (phrase indices, their feature rows) from the cells nearest to row,
+        # and the tail
+        if self._centroids is None:
+            return np.arange(self.size), self.features
+        order, bounds, features = self._cells
+        distances = self._distances(row[None, :])[0]
+        probe = min(self.probe, len(distances))
+        slices = [
+            slice(bounds[c], bounds[c + 1])
+            for c in np.argpartition(distances, probe - 1)[:probe].tolist()
+        ]
+        return (
+            np.concatenate(
+                [order[s] for s in slices] + [np.arange(self._celled, self.size)]
+            ),
+            np.concatenate(
+                [features[s] for s in slices]
+                + [self.features[self._celled : self.size]]
+            ),
+        )
+
+    def find(self, phrase):
+        # Index of a phrase with exactly the same notes, or None
+        self.update()
+        index = self.keys.get(phrase_hash(phrase))
+        # hashes are 64 bits, but a collision must not pass for a match
+        if index is not None and self.library.key(index) == phrase.key():
+            return index
+        return None
+
+    def nearest(self, phrase, k=5):
+        """
+        The k most similar phrases as [(index, squared distance), ...], closest
+        first. phrase may also be a feature row from phrase_features().
+        """
+        self.update()
+        row = phrase if isinstance(phrase, np.ndarray) else phrase_features(phrase)
+        indices, rows = self._candidates(row)
+        if not len(rows):
+            return []
+        rows = rows - row
+        distances = np.einsum("ij,ij->i", rows, rows)
+        k = min(k, len(distances))
+        best = np.argpartition(distances, k - 1)[:k]
+        best = best[np.argsort(distances[best], kind="stable")]
+        return list(zip(indices[best].tolist(), distances[best].tolist()))
+
+    def new_phrases(self, library):
+        # Indices of phrases in another PhraseLibrary that are in neither this
+        # index nor earlier in that library
+        self.update()
+        incoming = library_hashes(library)
+        _, first = np.unique(incoming, return_index=True)
+        first.sort()
+        keys = self.keys
+        fresh = [i for i in first.tolist() if int(incoming[i]) not in keys]
+        return np.array(fresh, dtype=np.int64)
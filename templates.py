@@ -0,0 +1,140 @@
+# Compiled phrases. The pitch skeleton of a phrase only depends on the raga and
+# the starting scale step, so it is worked out once into flat arrays and the
+# per-performance parts (base_duration, velocity, wobble) are applied on render.
+import mido
+import numpy as np
+
+from timing import cumulative_ticks
+
+NOTE = 0  # plain note
+KEYSWITCH = 1  # note played with a meendh keyswitch around it
+GLIDE = 2  # note whose meendh is played as a pitch bend glide
+
+RENDER_VERSION = 2  # part of every cache key; bump when rendered output changes
+
+
+class KeyswitchMessage(mido.Message):
+    """
+    A keyswitch note_on or note_off. It selects an articulation rather than
+    sounding, so velocity shaping skips it whatever its note number.
+    """
+
+
+class PhraseTemplate:
+    """Array-backed skeleton of one Phrase at one start step."""
+
+    def __init__(
+        self, notes, rel_times, kinds, keyswitches, scale_type, steps, glides, key
+    ):
+        self.notes = notes  # midi note per phrase note
+        self.rel_times = rel_times  # relative durations, scaled by base ticks
+        self.kinds = kinds  # NOTE, KEYSWITCH or GLIDE
+        self.keyswitches = keyswitches  # keyswitch note, -1 when there is none
+        self.scale_type = scale_type
+        self.steps = steps  # scale step of each note, for bends
+        self.glides = glides  # scale steps each GLIDE note bends towards
+        self.key = key  # stable identity of (raga, phrase, start step) for caches
+
+    def __len__(self):
+        return len(self.notes)
+
+    def durations(self, base_ticks):
+        # Note lengths in ticks for a base_duration of base_ticks
+        return cumulative_ticks(self.rel_times, base_ticks)
+
+    def render(
+        self,
+        base_ticks,
+        velocity,
+        seconds_per_tick,
+        wobble_mask=None,
+        wobble=None,
+        glide=None,
+    ):
+        # Returns the messages and the phrase length in ticks. Message times
+        # are in seconds, since that is what playback sleeps on.
+        # wobble_mask marks the notes that get a vibrato instead of a plain note;
+        # wobble(index, duration) and glide(index, duration) return the
+        # pitchwheel messages for those notes
+        durations = self.durations(base_ticks)
+        notes = self.notes.tolist()
+        kinds = self.kinds.tolist()
+        keyswitches = self.keyswitches.tolist()
+        times = (durations * seconds_per_tick).tolist()
+
+        midi_sequence = []
+        for i, midi_note in enumerate(notes):
+            actual_duration = times[i]
+            if wobble_mask is not None and wobble_mask[i]:
+                midi_sequence.append(mido.Message("note_on", note=midi_note))
+                midi_sequence += wobble(i, actual_duration)
+            elif kinds[i] == GLIDE and glide is not None:
+                midi_sequence.append(
+                    mido.Message("note_on", note=midi_note, velocity=velocity)
+                )
+                midi_sequence += glide(i, actual_duration)
+                midi_sequence.append(mido.Message("note_off", note=midi_note))
+                midi_sequence.append(mido.Message("pitchwheel", pitch=0))
+                continue
+            elif kinds[i] == KEYSWITCH:
+                keysw = keyswitches[i]
+                midi_sequence.append(KeyswitchMessage("note_on", note=keysw))
+                midi_sequence.append(
+                    mido.Message(
+                        "note_on",
+                        note=midi_note,
+                        velocity=velocity,
+                        time=actual_duration,
+                    )
+                )
+                midi_sequence.append(KeyswitchMessage("note_off", note=keysw))
+            else:
+                midi_sequence.append(
+                    mido.Message(
+                        "note_on",
+                        note=midi_note,
+                        velocity=velocity,
+                        time=actual_duration,
+                    )
+                )
+            midi_sequence.append(mido.Message("note_off", note=midi_note))
+
+        return midi_sequence, int(durations.sum())
+
+
+def compile_phrase(phrase, raga, start_scale_step=0):
+    scale_type = phrase.get_scale_type()
+    scale = raga.arohana if scale_type == "arohana" else raga.avarohana
+    scale = np.asarray(scale, dtype=np.int16)
+
+    increments, rel_times, meendhs = phrase.columns()
+    positions = start_scale_step + np.cumsum(increments)
+    octave_shift, note_index = np.divmod(positions, len(scale))
+    notes = scale[note_index] + 12 * octave_shift
+
+    keyswitches = np.array(
+        [
+            raga.meendhMap[meendh] if meendh in raga.meendhMap else -1
+            for meendh in meendhs
+        ],
+        dtype=np.int16,
+    )
+    # a keyswitch of 0 was never played (it is falsy), so treat it as none
+    keyswitches[keyswitches == 0] = -1
+    glides = np.array(
+        [raga.meendh_bends.get(meendh, 0) for meendh in meendhs],
+        dtype=np.int8,
+    )
+    kinds = np.where(keyswitches >= 0, KEYSWITCH, NOTE).astype(np.int8)
+    kinds[glides != 0] = GLIDE
+
+    return PhraseTemplate(
+        notes.astype(np.int16),
+        rel_times,
+        kinds,
+        keyswitches,
+        scale_type,
+        note_index,
+        glides,
+        (RENDER_VERSION, raga.fingerprint, phrase.key(), start_scale_step),
+    )
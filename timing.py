@@ -0,0 +1,28 @@
+# Integer tick time. Lengths are counted in ticks at PPQ ticks per beat and only
+# turned into seconds where messages leave for a port or a file.
+import numpy as np
+
+PPQ = 480
+
+
+def beats_to_ticks(beats, ppq=PPQ):
+    return int(round(beats * ppq))
+
+
+def ticks_to_beats(ticks, ppq=PPQ):
+    return ticks / ppq
+
+
+def seconds_to_ticks(seconds, bpm, ppq=PPQ):
+    return int(round(seconds * bpm / 60 * ppq))
+
+
+def ticks_to_seconds(ticks, bpm, ppq=PPQ):
+    return ticks * 60 / (bpm * ppq)
+
+
+def cumulative_ticks(relative_durations, base_ticks):
+    # Note lengths in ticks, rounded on the running total so the phrase as a
+    # whole never drifts from sum(relative_durations) * base_ticks
+    ends = np.rint(np.cumsum(relative_durations) * base_ticks).astype(np.int64)
+    return np.diff(ends, prepend=0)
@@ -0,0 +1,151 @@
+# Phrase variation: mutated copies of existing phrases and random new ones.
+# mutate_phrases and generate_random_phrases make thousands of variants in a
+# few NumPy passes and return them as a PhraseLibrary.
+import random
+
+import numpy as np
+
+from main import Note, Phrase, PhraseLibrary
+
+STEP_LIMIT = 2  # mutated steps stay within [-STEP_LIMIT, STEP_LIMIT]
+DURATION_CHOICES = [0.25, 0.5, 0.75, 1, 1.25, 1.5]
+FIRST_DURATIONS = [0.5, 1, 1.5]  # random phrases scale the rest by this
+RANDOM_MEENDHS = [None, None, None, "updown", "updown"]
+
+
+def mutate_phrase(phrase, meendh_names, rng=random):
+    mutated_notes = []
+
+    for note in phrase.notes:
+        # Randomly decide whether to mutate each aspect of the note
+        mutate_step = rng.choice([True, False])
+        mutate_duration = rng.choice([True, False])
+        mutate_meendh = rng.choice([True, False])
+
+        new_step = note.increment
+        new_duration = note.relative_duration
+        new_meendh = note.meendh
+
+        # Mutate step
+        if mutate_step:
+            new_step += rng.choice([-1, 0, 1])
+            new_step = max(-STEP_LIMIT, min(STEP_LIMIT, new_step))
+
+        # Mutate duration
+        if mutate_duration:
+            new_duration = rng.choice(DURATION_CHOICES)
+
+        # Mutate meendh
+        if mutate_meendh:
+            meendh_choices = [None] + list(meendh_names)
+            new_meendh = rng.choice(meendh_choices)
+
+        mutated_notes.append(Note(new_step, new_duration, new_meendh))
+
+    return Phrase(mutated_notes)
+
+
+def generate_random_phrase(num_notes, rng=random):
+    notes = []
+
+    # Ensure the first note's step is always 0
+    step = 0
+    first_duration = rng.choice(FIRST_DURATIONS)
+    notes.append(Note(step, first_duration))
+
+    # Generate the rest of the notes
+    for _ in range(1, num_notes):
+        # Adjust the probability of the next step based on the previous step
+        if step == 0:
+            step = rng.choice([-1, 1])
+        else:
+            step = rng.choice([step, step, step, -1, 0, 1])
+
+        duration = rng.choice(DURATION_CHOICES) * first_duration
+        meendh = rng.choice(RANDOM_MEENDHS)
+        notes.append(Note(step, duration, meendh))
+
+    return Phrase(notes)
+
+
+def mutate_phrases(phrase, count, meendh_names, rng=None):
+    """
+    `count` mutations of a phrase, as a PhraseLibrary. Same odds as
+    mutate_phrase: each note's step, duration and meendh change with
+    probability 1/2. rng is a NumPy Generator (see rng.make_np_rng).
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    increments, durations, meendhs = phrase.columns()
+    shape = (count, len(increments))
+
+    library = PhraseLibrary()
+    codes = library.meendh_codes_for(meendhs)
+    choices = library.meendh_codes_for([None] + list(meendh_names))
+
+    stepped = np.clip(
+        increments + rng.integers(-1, 2, size=shape), -STEP_LIMIT, STEP_LIMIT
+    )
+    increments = np.where(rng.random(shape) < 0.5, stepped, increments)
+    durations = np.where(
+        rng.random(shape) < 0.5,
+        np.asarray(DURATION_CHOICES, dtype=np.float64)[
+            rng.integers(len(DURATION_CHOICES), size=shape)
+        ],
+        durations,
+    )
+    codes = np.where(
+        rng.random(shape) < 0.5,
+        choices[rng.integers(len(choices), size=shape)],
+        codes,
+    )
+
+    library.extend_arrays(
+        increments.ravel(), durations.ravel(), codes.ravel(), np.full(count, shape[1])
+    )
+    return library
+
+
+def generate_random_phrases(count, num_notes, rng=None):
+    """
+    `count` random phrases, as a PhraseLibrary, drawn like
+    generate_random_phrase. num_notes is a length, or a (low, high) range
+    drawn from per phrase. The first note's step is always 0.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    if isinstance(num_notes, tuple):
+        low, high = num_notes
+        lengths = rng.integers(low, high + 1, size=count)
+    else:
+        lengths = np.full(count, num_notes)
+    longest = int(lengths.max()) if count else 0
+    shape = (count, longest)
+
+    # a step depends on the one before, so walk the columns, every phrase at once
+    steps = np.zeros(shape, dtype=np.int64)
+    for j in range(1, longest):
+        previous = steps[:, j - 1]
+        from_zero = np.where(rng.random(count) < 0.5, -1, 1)
+        # [previous] * 3 + [-1, 0, 1]
+        pick = rng.integers(6, size=count)
+        otherwise = np.where(pick < 3, previous, pick - 4)
+        steps[:, j] = np.where(previous == 0, from_zero, otherwise)
+
+    first = np.asarray(FIRST_DURATIONS, dtype=np.float64)[
+        rng.integers(len(FIRST_DURATIONS), size=count)
+    ]
+    durations = np.asarray(DURATION_CHOICES, dtype=np.float64)[
+        rng.integers(len(DURATION_CHOICES), size=shape)
+    ]
+    durations = durations * first[:, None]
+    if longest:
+        durations[:, 0] = first
+
+    library = PhraseLibrary()
+    choices = library.meendh_codes_for(RANDOM_MEENDHS)
+    codes = choices[rng.integers(len(choices), size=shape)]
+    if longest:
+        codes[:, 0] = 0  # the first note has no meendh
+
+    used = np.arange(longest) < lengths[:, None]
+    library.extend_arrays(steps[used], durations[used], codes[used], lengths)
+    return library